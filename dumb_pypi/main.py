@@ -9,31 +9,77 @@ package list.
 """
 from __future__ import annotations
 
+import abc
 import argparse
 import collections
+import concurrent.futures
 import contextlib
+import functools
+import hashlib
+import io
+import importlib.util
 import inspect
 import itertools
 import json
-import math
+import marshal
+import multiprocessing
+import operator
 import os.path
 import re
+import shutil
+import signal
 import sys
+import tarfile
 import tempfile
+import threading
+import time
+import zlib
+from collections.abc import Callable
 from collections.abc import Generator
-from collections.abc import Iterator
+from collections.abc import Iterable
 from collections.abc import Sequence
 from datetime import datetime
 from typing import Any
 from typing import IO
 from typing import NamedTuple
+from typing import Protocol
+from typing import TYPE_CHECKING
+from typing import TypeVar
 
-import jinja2
+import packaging
 import packaging.utils
 import packaging.version
 
+if TYPE_CHECKING:
+    import jinja2
+
 CHANGELOG_ENTRIES_PER_PAGE = 5000
+PARSE_CHUNK_SIZE = 10000
+RENDER_CHUNK_SIZE = 100
+TAR_BUFFER_SIZE = 1 << 20
+# Suffixes -> TarSink compression
+ARCHIVE_SUFFIXES = {
+    ('.tar',): None,
+    ('.tar.gz', '.tgz'): 'gz',
+    ('.tar.zst', '.tzst'): 'zst',
+}
+STREAM_BUFFER_SIZE = 1000
+SIMPLE_API_VERSION = '1.1'
+SEARCH_PREFIX_LENGTH = 2
+SEARCH_MAX_RESULTS = 500
+PROFILE_SAMPLE_INTERVAL = 0.001
+PARSE_CACHE_VERSION = 2
+# Bump this whenever the output layout changes, so that the next build of an
+# existing output directory rewrites everything.
+STATE_VERSION = 4
+DIGEST_MOD = 1 << 128
+# Directory inside the output directory for state kept between runs.
+STATE_DIR = '.dumb-pypi'
+GENERATIONS_DIR = '.generations'
+CURRENT_GENERATION = 'current'
 DIGIT_RE = re.compile('([0-9]+)', re.ASCII)
+NEEDS_ESCAPE_RE = re.compile('[&<>"\']')
+SAFE_FILENAME_RE = re.compile(r'[a-zA-Z0-9_\-\.\+]+$')
 # Copied from distlib/wheel.py
 WHEEL_FILENAME_RE = re.compile(r'''
 (?P<nm>[^-]+)
@@ -45,6 +91,9 @@ WHEEL_FILENAME_RE = re.compile(r'''
 \.whl$
 ''', re.IGNORECASE | re.VERBOSE)
 
+T = TypeVar('T')
+U = TypeVar('U')
+
 
 def remove_extension(name: str) -> str:
     if name.endswith(('gz', 'bz2')):
@@ -98,6 +147,97 @@ def _natural_key(s: str) -> tuple[int | str, ...]:
     )
 
 
+def _intern(s: str | None) -> str | None:
+    return sys.intern(s) if s is not None else None
+
+
+ParsedFilename = tuple[str, str | None, packaging.version.Version]
+
+
+def _parse_filename(filename: str) -> ParsedFilename:
+    """Return the canonical name, version, and parsed version of a file."""
+    name, version = guess_name_version_from_filename(filename)
+    return (
+        packaging.utils.canonicalize_name(name),
+        version,
+        packaging.version.parse(version or '0'),
+    )
+
+
+class ParseCache:
+    """Cache of filename -> (name, version, parsed_version).
+
+    This is persisted in the output directory between runs since almost all
+    filenames are the same as last time. Only the entries which were looked
+    up during this run are saved, so files which are no longer listed are
+    pruned from the cache.
+
+    It is saved with marshal as columns of filenames, names and version
+    strings. Files of the same release share a version, so each distinct
+    version is only parsed once when the cache is loaded.
+    """
+
+    def __init__(self, entries: dict[str, ParsedFilename] | None = None) -> None:
+        self.entries = entries if entries is not None else {}
+        self.used: dict[str, ParsedFilename] = {}
+
+    @classmethod
+    def load(cls, path: str) -> ParseCache:
+        try:
+            with open(path, 'rb') as f:
+                # marshal.load reads a file in tiny pieces, which is much slower.
+                header, filenames, names, versions = marshal.loads(f.read())
+            if header != cls._header():
+                return cls()
+            parsed_versions: dict[str | None, packaging.version.Version] = {}
+            entries = {}
+            for filename, name, version in zip(filenames, names, versions, strict=True):
+                parsed_version = parsed_versions.get(version)
+                if parsed_version is None:
+                    parsed_version = parsed_versions[version] = packaging.version.parse(version or '0')
+                entries[filename] = (name, version, parsed_version)
+        except FileNotFoundError:
+            return cls()
+        except Exception as ex:
+            print(f'Ignoring unreadable parse cache {path}: {ex!r}', file=sys.stderr)
+            return cls()
+        return cls(entries)
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path, 'wb') as f:
+            marshal.dump((
+                self._header(),
+                list(self.used),
+                [name for name, _, _ in self.used.values()],
+                [version for _, version, _ in self.used.values()],
+            ), f)
+
+    @staticmethod
+    def _header() -> tuple[int, str]:
+        # Names are canonicalized by packaging, so a new version of it (or of
+        # our own parsing) invalidates the whole cache.
+        return PARSE_CACHE_VERSION, packaging.__version__
+
+    def subset(self, filenames: Iterable[str]) -> ParseCache:
+        return ParseCache({
+            filename: self.entries[filename]
+            for filename in filenames
+            if filename in self.entries
+        })
+
+    def parse(self, filename: str) -> ParsedFilename:
+        try:
+            parsed = self.entries[filename]
+        except KeyError:
+            parsed = _parse_filename(filename)
+        self.used[filename] = parsed
+        return parsed
+
+    def remember(self, package: Package) -> None:
+        self.used[package.filename] = (package.name, package.version, package.parsed_version)
+
+
 class Package(NamedTuple):
     filename: str
     name: str
@@ -110,6 +250,7 @@ class Package(NamedTuple):
     upload_timestamp: int | None
     uploaded_by: str | None
     yanked_reason: str | None
+    size: int | None
 
     def __lt__(self, other: tuple[Any, ...]) -> bool:
         assert isinstance(other, Package), type(other)
@@ -135,21 +276,6 @@ class Package(NamedTuple):
         dt = datetime.utcfromtimestamp(self.upload_timestamp)
         return _format_datetime(dt)
 
-    @property
-    def info_string(self) -> str:
-        # TODO: I'd like to remove this "info string" and instead format things
-        # nicely for humans (e.g. in a table or something).
-        #
-        # This might mean changing the web interface to use different pages for
-        # humans than the /simple/ ones it currently links to. (Even if pip can
-        # parse links from a <table>, it might add significantly more bytes.)
-        info = self.version or 'unknown version'
-        if self.upload_timestamp is not None:
-            info += f', {self.formatted_upload_time}'
-        if self.uploaded_by is not None:
-            info += f', {self.uploaded_by}'
-        return info
-
     def url(self, base_url: str, *, include_hash: bool = True) -> str:
         hash_part = f'#{self.hash}' if self.hash and include_hash else ''
         return f'{base_url.rstrip("/")}/{self.filename}{hash_part}'
@@ -177,13 +303,39 @@ class Package(NamedTuple):
         if self.hash is not None:
             algo, h = self.hash.split('=')
             ret['digests'] = {algo: h}
+        if self.size is not None:
+            ret['size'] = self.size
+        return ret
+
+    def simple_json_info(self, base_url: str) -> dict[str, Any]:
+        """The file entry for the JSON simple API (PEP 691 and PEP 700)."""
+        ret: dict[str, Any] = {
+            'filename': self.filename,
+            'url': self.url(base_url, include_hash=False),
+            'hashes': dict([self.hash.split('=', 1)]) if self.hash else {},
+        }
+        if self.requires_python:
+            ret['requires-python'] = self.requires_python
+        if self.core_metadata:
+            core_metadata = (
+                True if self.core_metadata == 'true'
+                else dict([self.core_metadata.split('=', 1)])
+            )
+            ret['core-metadata'] = core_metadata
+            # The old name from PEP 658, still read by older pip versions.
+            ret['dist-info-metadata'] = core_metadata
+        ret['yanked'] = self.yanked_reason or False
+        if self.upload_timestamp is not None:
+            ret['upload-time'] = datetime.utcfromtimestamp(self.upload_timestamp).strftime('%Y-%m-%dT%H:%M:%SZ')
+        if self.size is not None:
+            ret['size'] = self.size
         return ret
 
     def input_json(self) -> dict[str, Any]:
         """A dict suitable for json lines."""
         return {
             k: getattr(self, k)
-            for k in inspect.getfullargspec(self.create).kwonlyargs
+            for k in _INPUT_JSON_FIELDS
             if getattr(self, k) is not None
         }
 
@@ -199,34 +351,52 @@ class Package(NamedTuple):
             uploaded_by: str | None = None,
             yanked_reason: str | None = None,
             core_metadata: str | None = None,
+            size: int | None = None,
+            parse_cache: ParseCache | None = None,
     ) -> Package:
-        if not re.match(r'[a-zA-Z0-9_\-\.\+]+$', filename) or '..' in filename:
+        if not SAFE_FILENAME_RE.match(filename) or '..' in filename:
             raise ValueError(f'Unsafe package name: {filename}')
 
-        name, version = guess_name_version_from_filename(filename)
+        if parse_cache is not None:
+            name, version, parsed_version = parse_cache.parse(filename)
+        else:
+            name, version, parsed_version = _parse_filename(filename)
         return cls(
             filename=filename,
-            name=packaging.utils.canonicalize_name(name),
+            name=name,
             version=version,
-            parsed_version=packaging.version.parse(version or '0'),
+            parsed_version=parsed_version,
             hash=hash,
             requires_dist=tuple(requires_dist) if requires_dist is not None else None,
-            requires_python=requires_python,
+            # These are repeated across many files, so intern them rather than
+            # keeping a separate copy from each line of the input.
+            requires_python=_intern(requires_python),
             core_metadata=core_metadata,
             upload_timestamp=upload_timestamp,
-            uploaded_by=uploaded_by,
+            uploaded_by=_intern(uploaded_by),
             yanked_reason=yanked_reason,
+            size=size,
         )
 
 
+# The fields of a Package which come from the input, in the order of the
+# arguments to Package.create. Computed once since inspect is slow, and
+# input_json is called for every file.
+_INPUT_JSON_FIELDS = tuple(
+    k for k in inspect.getfullargspec(Package.create).kwonlyargs
+    if k in Package._fields
+)
+_input_json_values = operator.attrgetter(*_INPUT_JSON_FIELDS)
+
+
 @contextlib.contextmanager
-def atomic_write(path: str) -> Generator[IO[str]]:
+def atomic_write(path: str, mode: str = 'w') -> Generator[IO[Any]]:
     tmp = tempfile.mktemp(
         prefix='.' + os.path.basename(path),
         dir=os.path.dirname(path),
     )
     try:
-        with open(tmp, 'w') as f:
+        with open(tmp, mode) as f:
             yield f
     except BaseException:
         os.remove(tmp)
@@ -235,6 +405,442 @@ def atomic_write(path: str) -> Generator[IO[str]]:
         os.replace(tmp, path)
 
 
+class _Unchanged(Exception):
+    pass
+
+
+def _read_if_size(path: str, size: int) -> bytes | None:
+    """Return the contents of path if it exists and has the given size."""
+    try:
+        if os.stat(path).st_size != size:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _file_digest(path: str) -> bytes | None:
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                digest.update(block)
+    except FileNotFoundError:
+        return None
+    return digest.digest()
+
+
+class _Compressor(Protocol):
+    def compress(self, data: bytes, /) -> bytes: ...
+    def flush(self) -> bytes: ...
+
+
+class _BrotliCompressor:
+    def __init__(self) -> None:
+        import brotli
+        self._compressor = brotli.Compressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
+
+
+def _gzip_compressor() -> _Compressor:
+    # wbits=31 makes a gzip stream; zlib leaves the header mtime at 0 so the
+    # output only depends on the content.
+    return zlib.compressobj(9, zlib.DEFLATED, 31)
+
+
+# Format name -> (file suffix, compressor factory)
+PRECOMPRESS_FORMATS: dict[str, tuple[str, Callable[[], _Compressor]]] = {
+    'gzip': ('.gz', _gzip_compressor),
+    'brotli': ('.br', _BrotliCompressor),
+}
+
+
+class OutputSink(abc.ABC):
+    """Where build_repo puts the files it generates.
+
+    Paths are relative to the root of the repository and always use '/'.
+    Sinks count the files they write, skip and delete, and the bytes they
+    write (before any compression).
+    """
+
+    def __init__(self) -> None:
+        self.written = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.bytes_written = 0
+
+    def __enter__(self) -> OutputSink:
+        return self
+
+    def __exit__(self, exc_type: type[BaseException] | None, *_: object) -> None:
+        self.close(raise_error=exc_type is None)
+
+    @abc.abstractmethod
+    def write(self, path: str, content: str | Iterable[str]) -> None:
+        """Write content (a string, or an iterable of strings) to path."""
+
+    @abc.abstractmethod
+    def delete(self, path: str) -> None:
+        """Delete path, if it exists."""
+
+    def flush(self) -> None:
+        """Wait until everything written so far is stored."""
+
+    def close(self, *, raise_error: bool = True) -> None:
+        """Finish writing. raise_error is false if the build failed."""
+
+
+class MemorySink(OutputSink):
+    """Keeps the files in a dict, mostly for tests."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.files: dict[str, bytes] = {}
+
+    def write(self, path: str, content: str | Iterable[str]) -> None:
+        data = (content if isinstance(content, str) else ''.join(content)).encode()
+        self.files[path] = data
+        self.written += 1
+        self.bytes_written += len(data)
+
+    def delete(self, path: str) -> None:
+        if self.files.pop(path, None) is not None:
+            self.deleted += 1
+
+
+class TarSink(OutputSink):
+    """Writes the files into a tar archive as one sequential stream.
+
+    compression can be 'gz' or 'zst' (which needs the zstandard package).
+    Deleted paths can't be removed from an archive, so they are listed in
+    the DELETED_MEMBER file at the end of it instead.
+    """
+
+    DELETED_MEMBER = f'{STATE_DIR}/deleted'
+
+    def __init__(self, path: str, *, compression: str | None = None) -> None:
+        if compression not in (None, 'gz', 'zst'):
+            raise ValueError(f'Unsupported archive compression: {compression}')
+        super().__init__()
+        self.path = path
+        self.mtime = int(time.time())
+        self.deleted_paths: list[str] = []
+        # Like atomic_write, the archive only replaces path once it's complete.
+        self._tmp = tempfile.mktemp(prefix='.' + os.path.basename(path), dir=os.path.dirname(path))
+        self._file = open(self._tmp, 'wb')
+        self._zstd_writer = None
+        fileobj: IO[bytes] = self._file
+        if compression == 'zst':
+            import zstandard
+            self._zstd_writer = zstandard.ZstdCompressor().stream_writer(self._file, closefd=False)
+            fileobj = self._zstd_writer
+            compression = None
+        self._tar = tarfile.open(
+            fileobj=fileobj,
+            mode='w|gz' if compression == 'gz' else 'w|',
+            bufsize=TAR_BUFFER_SIZE,
+            format=tarfile.PAX_FORMAT,
+        )
+
+    def write(self, path: str, content: str | Iterable[str]) -> None:
+        # The size goes before the data in a tar file, so streamed content is
+        # spooled first (to disk, if it turns out to be large).
+        with tempfile.SpooledTemporaryFile(max_size=TAR_BUFFER_SIZE) as f:
+            for chunk in (content,) if isinstance(content, str) else content:
+                f.write(chunk.encode())
+            size = f.tell()
+            f.seek(0)
+            self._tar.addfile(self._tar_info(path, size), f)
+        self.written += 1
+        self.bytes_written += size
+
+    def delete(self, path: str) -> None:
+        self.deleted_paths.append(path)
+        self.deleted += 1
+
+    def close(self, *, raise_error: bool = True) -> None:
+        if self._file.closed:
+            return
+        try:
+            try:
+                if raise_error and self.deleted_paths:
+                    data = ''.join(f'{path}\n' for path in self.deleted_paths).encode()
+                    self._tar.addfile(self._tar_info(self.DELETED_MEMBER, len(data)), io.BytesIO(data))
+                # Always finish the streams, even for a failed build, so
+                # nothing is left to flush into a closed file later.
+                self._tar.close()
+                if self._zstd_writer is not None:
+                    self._zstd_writer.close()
+            finally:
+                self._file.close()
+        except BaseException:
+            os.remove(self._tmp)
+            raise
+        if raise_error:
+            os.replace(self._tmp, self.path)
+        else:
+            # The build failed; keep any previous archive.
+            os.remove(self._tmp)
+
+    def _tar_info(self, path: str, size: int) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(path)
+        info.size = size
+        info.mtime = self.mtime
+        info.mode = 0o644
+        return info
+
+
+class OutputDirectory(OutputSink):
+    """Writes files into the output directory.
+
+    With skip_unchanged, files whose contents would be identical to what is
+    already on disk are left alone, so their mtime doesn't change and tools
+    syncing the output elsewhere don't see them as modified.
+
+    With io_threads, writes and deletions happen in background threads while
+    the caller keeps rendering. At most max_pending operations are queued at
+    once (further calls block until one finishes), operations on the same
+    path still happen in order, and the first error is raised from the next
+    call or from flush().
+
+    With precompress, every file written also gets compressed siblings (e.g.
+    index.html.gz) for webservers to serve directly. They are compressed
+    while the file is written, so with io_threads that happens in the
+    background threads too.
+
+    With manifest, a JSON line is written to it for every file created,
+    updated or deleted, so the changes can be published without comparing
+    the whole tree.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            *,
+            skip_unchanged: bool = False,
+            io_threads: int = 0,
+            max_pending: int | None = None,
+            precompress: Sequence[str] = (),
+            manifest: IO[str] | None = None,
+    ) -> None:
+        super().__init__()
+        self.path = path
+        self.skip_unchanged = skip_unchanged
+        self.precompress = [PRECOMPRESS_FORMATS[fmt] for fmt in precompress]
+        self.manifest = manifest
+        self._lock = threading.Lock()
+        self._executor: concurrent.futures.ThreadPoolExecutor | None = None
+        self._pending: dict[str, concurrent.futures.Future[None]] = {}
+        self._slots = threading.BoundedSemaphore(max_pending or io_threads * 64 or 1)
+        self._error: BaseException | None = None
+        if io_threads > 0:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=io_threads,
+                thread_name_prefix='dumb-pypi-io',
+            )
+
+    def write(self, path: str, content: str | Iterable[str]) -> None:
+        """Write content to path (relative to the output directory).
+
+        Content can also be an iterable of strings, which is written as it
+        is produced instead of being joined in memory first.
+        """
+        self._submit((path,), self._write, path, content)
+
+    def delete(self, path: str) -> None:
+        """Delete path, and its directory if that leaves it empty."""
+        # Removing the directory could race with writes into it, so the
+        # deletion also waits for (and blocks) everything in the directory.
+        directory_key = os.path.join(os.path.dirname(path), '')
+        self._submit((path, directory_key), self._delete, path, whole_directory=True)
+
+    def flush(self) -> None:
+        """Wait for all queued operations, raising the first error if any."""
+        with self._lock:
+            futures = set(self._pending.values())
+        concurrent.futures.wait(futures)
+        self._raise_error()
+
+    def close(self, *, raise_error: bool = True) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._pending.clear()
+        if raise_error:
+            self._raise_error()
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _submit(
+            self,
+            keys: tuple[str, ...],
+            fn: Callable[..., None],
+            *args: Any,
+            whole_directory: bool = False,
+    ) -> None:
+        self._raise_error()
+        if self._executor is None:
+            fn(*args)
+            return
+
+        # Wait for earlier operations on the same path and for deletions in
+        # the same directory, or for anything in the directory when deleting.
+        directory = os.path.dirname(keys[0])
+        with self._lock:
+            waits = {
+                self._pending[key]
+                for key in (*keys, os.path.join(directory, ''))
+                if key in self._pending
+            }
+            if whole_directory:
+                waits.update(
+                    future for key, future in self._pending.items()
+                    if os.path.dirname(key) == directory
+                )
+        if waits:
+            concurrent.futures.wait(waits)
+            self._raise_error()
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            for key in keys:
+                self._pending[key] = future
+        future.add_done_callback(functools.partial(self._done, keys))
+
+    def _done(self, keys: tuple[str, ...], future: concurrent.futures.Future[None]) -> None:
+        with self._lock:
+            for key in keys:
+                if self._pending.get(key) is future:
+                    del self._pending[key]
+            error = future.exception()
+            if error is not None and self._error is None:
+                self._error = error
+        self._slots.release()
+
+    def _write(self, path: str, content: str | Iterable[str]) -> None:
+        full_path = os.path.join(self.path, path)
+        try:
+            if isinstance(content, str):
+                size = self._write_bytes(full_path, content.encode())
+            else:
+                size = self._write_chunks(full_path, content)
+        except _Unchanged:
+            self._precompress_missing(full_path)
+            with self._lock:
+                self.skipped += 1
+        else:
+            with self._lock:
+                self.written += 1
+                self.bytes_written += size
+
+    def _delete(self, path: str) -> None:
+        full_path = os.path.join(self.path, path)
+        try:
+            os.remove(full_path)
+        except FileNotFoundError:
+            return
+        self._record(full_path, 'delete')
+        for suffix, _ in self.precompress:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(full_path + suffix)
+                self._record(full_path + suffix, 'delete')
+        with self._lock:
+            self.deleted += 1
+        with contextlib.suppress(OSError):
+            os.rmdir(os.path.dirname(full_path))
+
+    def _record(self, full_path: str, action: str, digest: hashlib._Hash | None = None) -> None:
+        if self.manifest is None:
+            return
+        entry = {'path': os.path.relpath(full_path, self.path), 'action': action}
+        if digest is not None:
+            entry['sha256'] = digest.hexdigest()
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self.manifest.write(line)
+
+    @contextlib.contextmanager
+    def _open(self, full_path: str) -> Generator[tuple[Callable[[bytes], None], hashlib._Hash]]:
+        """Atomically write full_path and its compressed siblings together.
+
+        Yields a function to write data and the running digest of it.
+        Raising inside the block discards all of the files and leaves the old
+        ones in place.
+        """
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        paths = [full_path, *(full_path + suffix for suffix, _ in self.precompress)]
+        existed = [self.manifest is not None and os.path.exists(path) for path in paths]
+        digests = [hashlib.sha256() for _ in range(len(self.precompress) + 1)]
+        with contextlib.ExitStack() as ctx:
+            f = ctx.enter_context(atomic_write(full_path, 'wb'))
+            siblings = [
+                (ctx.enter_context(atomic_write(full_path + suffix, 'wb')), make_compressor(), digest)
+                for (suffix, make_compressor), digest in zip(self.precompress, digests[1:])
+            ]
+
+            def write(data: bytes) -> None:
+                f.write(data)
+                digests[0].update(data)
+                for sibling, compressor, digest in siblings:
+                    compressed = compressor.compress(data)
+                    sibling.write(compressed)
+                    digest.update(compressed)
+
+            yield write, digests[0]
+            for sibling, compressor, digest in siblings:
+                compressed = compressor.flush()
+                sibling.write(compressed)
+                digest.update(compressed)
+
+        for path, path_existed, digest in zip(paths, existed, digests):
+            self._record(path, 'update' if path_existed else 'create', digest)
+
+    def _precompress_missing(self, full_path: str) -> None:
+        """Compress an unchanged file if its siblings don't exist yet."""
+        for suffix, make_compressor in self.precompress:
+            if not os.path.exists(full_path + suffix):
+                with open(full_path, 'rb') as f:
+                    data = f.read()
+                compressor = make_compressor()
+                compressed = compressor.compress(data) + compressor.flush()
+                with atomic_write(full_path + suffix, 'wb') as sibling:
+                    sibling.write(compressed)
+                self._record(full_path + suffix, 'create', hashlib.sha256(compressed))
+
+    def _write_bytes(self, full_path: str, data: bytes) -> int:
+        if self.skip_unchanged and _read_if_size(full_path, len(data)) == data:
+            raise _Unchanged()
+        with self._open(full_path) as (write, _):
+            write(data)
+        return len(data)
+
+    def _write_chunks(self, full_path: str, chunks: Iterable[str]) -> int:
+        size = 0
+        with self._open(full_path) as (write, digest):
+            for chunk in chunks:
+                data = chunk.encode()
+                write(data)
+                size += len(data)
+            # Raising discards the temporary files without replacing the old ones.
+            if self.skip_unchanged and _file_digest(full_path) == digest.digest():
+                raise _Unchanged()
+        return size
+
+
 def _format_datetime(dt: datetime) -> str:
     return dt.strftime('%Y-%m-%d %H:%M:%S')
 
@@ -288,6 +894,380 @@ def _package_json(sorted_files: list[Package], base_url: str) -> dict[str, Any]:
     }
 
 
+def _search_prefix(package_name: str) -> str:
+    """The search index shard for a (normalized) package name."""
+    return package_name[:SEARCH_PREFIX_LENGTH]
+
+
+def _simple_api_meta(api_version: str) -> dict[str, Any]:
+    return {'api-version': api_version}
+
+
+def _simple_index_json(package_names: Iterable[str]) -> Generator[str]:
+    # https://peps.python.org/pep-0691/#project-list
+    # Produces the same text as json.dumps() of the whole document, but
+    # streamed like the HTML index so it is never held in memory at once.
+    yield f'{{"meta": {json.dumps(_simple_api_meta(SIMPLE_API_VERSION))}, "projects": ['
+    separator = ''
+    for chunk in _chunks(package_names, STREAM_BUFFER_SIZE):
+        yield separator + ', '.join([json.dumps({'name': package_name}) for package_name in chunk])
+        separator = ', '
+    yield ']}'
+
+
+def _simple_package_json(package_name: str, sorted_files: list[Package], base_url: str) -> dict[str, Any]:
+    # https://peps.python.org/pep-0691/#project-detail
+    # Version 1.1 (PEP 700) requires the size of every file, which is only
+    # known if it was passed in the input.
+    has_sizes = all(file_.size is not None for file_ in sorted_files)
+    return {
+        'meta': _simple_api_meta(SIMPLE_API_VERSION if has_sizes else '1.0'),
+        'name': package_name,
+        'versions': list(dict.fromkeys(
+            file_.version for file_ in sorted_files if file_.version is not None
+        )),
+        'files': [file_.simple_json_info(base_url) for file_ in sorted_files],
+    }
+
+
+def _files_by_version(files: Iterable[Package]) -> dict[str | None, list[Package]]:
+    version_to_files: dict[str | None, list[Package]] = collections.defaultdict(list)
+    for file_ in files:
+        version_to_files[file_.version].append(file_)
+    return version_to_files
+
+
+def _changelog_files(sorted_packages: dict[str, list[Package]]) -> list[Package]:
+    """Return every file in changelog order, oldest first."""
+    # Walking the already-sorted files in name order gives every file in
+    # sort_key order, so a stable sort on the timestamp alone orders ties
+    # without comparing any Packages.
+    return sorted(
+        itertools.chain.from_iterable(
+            sorted_packages[package_name] for package_name in sorted(sorted_packages)
+        ),
+        key=lambda package: -(package.upload_timestamp or 0),
+    )[::-1]
+
+
+def _changelog_pages(sorted_packages: dict[str, list[Package]]) -> list[list[Package]]:
+    """Split the changelog into pages of files, newest first within a page.
+
+    Pages are numbered from the oldest files, so a new upload only changes
+    the newest page(s) and the rest keep both their contents and their URLs.
+    The first list returned is page 1.
+    """
+    files_oldest_first = _changelog_files(sorted_packages)
+    return [
+        files_oldest_first[start_idx:start_idx + CHANGELOG_ENTRIES_PER_PAGE][::-1]
+        for start_idx in range(0, len(files_oldest_first), CHANGELOG_ENTRIES_PER_PAGE)
+    ]
+
+
+def _digest_package(package: Package) -> int:
+    # The repr of the input fields (strings, ints, None and tuples of strings)
+    # is stable and much quicker to build than JSON.
+    line = repr(_input_json_values(package))
+    return int.from_bytes(hashlib.blake2b(line.encode(), digest_size=16).digest(), 'big')
+
+
+def _format_digest(digest: int) -> str:
+    return f'{digest:032x}'
+
+
+class PackageIndex(dict[str, set[Package]]):
+    """Files by package name, along with digests of each package and release.
+
+    A package's digest is the sum of the digests of its files, so it doesn't
+    depend on their order and is kept up to date as files are added during
+    ingestion instead of being computed when comparing builds.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.package_digests: dict[str, int] = {}
+        self.release_digests: dict[str, dict[str | None, int]] = {}
+
+    @classmethod
+    def from_packages(cls, packages: dict[str, set[Package]]) -> PackageIndex:
+        if isinstance(packages, PackageIndex):
+            return packages
+        index = cls()
+        for files in packages.values():
+            for file_ in files:
+                index.add(file_)
+        return index
+
+    def add(self, package: Package, digest: int | None = None) -> None:
+        files = self.setdefault(package.name, set())
+        if package in files:
+            return
+        files.add(package)
+        if digest is None:
+            digest = _digest_package(package)
+        self.package_digests[package.name] = (self.package_digests.get(package.name, 0) + digest) % DIGEST_MOD
+        releases = self.release_digests.setdefault(package.name, {})
+        releases[package.version] = (releases.get(package.version, 0) + digest) % DIGEST_MOD
+
+    def remove(self, package: Package) -> None:
+        files = self[package.name]
+        files.remove(package)
+        digest = _digest_package(package)
+        self.package_digests[package.name] = (self.package_digests[package.name] - digest) % DIGEST_MOD
+        releases = self.release_digests[package.name]
+        releases[package.version] = (releases[package.version] - digest) % DIGEST_MOD
+        if not any(file_.version == package.version for file_ in files):
+            del releases[package.version]
+        if not files:
+            del self[package.name]
+            del self.package_digests[package.name]
+            del self.release_digests[package.name]
+
+    def copy(self) -> PackageIndex:
+        index = PackageIndex()
+        for package_name, files in self.items():
+            index[package_name] = set(files)
+        index.package_digests = dict(self.package_digests)
+        index.release_digests = {
+            package_name: dict(releases)
+            for package_name, releases in self.release_digests.items()
+        }
+        return index
+
+    def find(self, filename: str) -> Package | None:
+        name, _, _ = _parse_filename(filename)
+        for file_ in self.get(name, ()):
+            if file_.filename == filename:
+                return file_
+        return None
+
+    @property
+    def digest(self) -> int:
+        """Digest of every file in the index."""
+        return sum(self.package_digests.values()) % DIGEST_MOD
+
+
+def _changelog_page_digest(page: list[Package]) -> str:
+    # Only what is shown on the page matters.
+    return hashlib.blake2b(
+        json.dumps([
+            (file_.filename, file_.hash, file_.upload_timestamp, file_.uploaded_by)
+            for file_ in page
+        ]).encode(),
+        digest_size=16,
+    ).hexdigest()
+
+
+class RepoState(NamedTuple):
+    """Digests of the inputs to each part of a built repository.
+
+    Comparing this with the state of the previous build tells us which
+    outputs need to be rebuilt. It can be saved in the output directory so
+    that the next build doesn't need the previous package list at all.
+    """
+    # digest of every file
+    digest: str
+    # package name -> digest of all of its files
+    package_digests: dict[str, str]
+    # package name -> version -> digest of the files in that release
+    release_digests: dict[str, dict[str, str]]
+    # digest of the files on each changelog page, starting with page 1
+    changelog_digests: list[str]
+    # digest of the settings the outputs were generated with
+    settings_digest: str
+    # where the outputs were written (see _output_target)
+    output: str = ''
+
+    @classmethod
+    def create(
+            cls,
+            packages: PackageIndex,
+            changelog_pages: list[list[Package]],
+            settings: Settings,
+    ) -> RepoState:
+        return cls(
+            digest=_format_digest(packages.digest),
+            package_digests={
+                package_name: _format_digest(digest)
+                for package_name, digest in packages.package_digests.items()
+            },
+            release_digests={
+                package_name: {
+                    version: _format_digest(digest)
+                    for version, digest in releases.items()
+                    if version is not None
+                }
+                for package_name, releases in packages.release_digests.items()
+            },
+            changelog_digests=[_changelog_page_digest(page) for page in changelog_pages],
+            settings_digest=settings.output_digest(),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> RepoState | None:
+        """Load the state saved by a previous build, if there is a usable one."""
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            if state.get('version') != STATE_VERSION:
+                return None
+            return cls(
+                digest=state['digest'],
+                package_digests=state['package_digests'],
+                release_digests=state['release_digests'],
+                changelog_digests=state['changelog_digests'],
+                settings_digest=state['settings_digest'],
+                output=state['output'],
+            )
+        except FileNotFoundError:
+            return None
+        except Exception as ex:
+            print(f'Ignoring unreadable build state {path}: {ex!r}', file=sys.stderr)
+            return None
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path) as f:
+            json.dump({'version': STATE_VERSION, **self._asdict()}, f)
+
+
+def _cpu_time() -> float:
+    """CPU time of this process and of its finished child processes."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class BuildStats:
+    """Wall and CPU time spent in each phase of a build, plus counters.
+
+    A phase can be entered several times, and its times add up. Phases can
+    also be nested, in which case the outer one includes the inner ones.
+    CPU time includes worker processes once they have exited, so for the
+    phases run with --jobs it covers the workers too.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.cpu_started = _cpu_time()
+        # name -> [wall seconds, CPU seconds, calls]
+        self.phases: dict[str, list[float]] = {}
+        self.counters: collections.Counter[str] = collections.Counter()
+        # The phases currently running, outermost first.
+        self.active: list[str] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Generator[None]:
+        wall, cpu = time.perf_counter(), _cpu_time()
+        self.active.append(name)
+        try:
+            yield
+        finally:
+            self.active.pop()
+            totals = self.phases.setdefault(name, [0.0, 0.0, 0])
+            totals[0] += time.perf_counter() - wall
+            totals[1] += _cpu_time() - cpu
+            totals[2] += 1
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+
+    def count_output(self, output: OutputSink) -> None:
+        self.counters['files_written'] = output.written
+        self.counters['files_skipped'] = output.skipped
+        self.counters['files_deleted'] = output.deleted
+        self.counters['bytes_written'] = output.bytes_written
+
+    def merge(self, other: BuildStats) -> None:
+        """Add the phases and counters collected elsewhere (e.g. in a worker)."""
+        for name, (wall, cpu, calls) in other.phases.items():
+            totals = self.phases.setdefault(name, [0.0, 0.0, 0])
+            totals[0] += wall
+            totals[1] += cpu
+            totals[2] += calls
+        self.counters.update(other.counters)
+
+    def report(self) -> dict[str, Any]:
+        return {
+            'wall_seconds': round(time.perf_counter() - self.started, 6),
+            'cpu_seconds': round(_cpu_time() - self.cpu_started, 6),
+            'phases': {
+                name: {'wall_seconds': round(wall, 6), 'cpu_seconds': round(cpu, 6), 'calls': int(calls)}
+                for name, (wall, cpu, calls) in self.phases.items()
+            },
+            'counters': dict(sorted(self.counters.items())),
+        }
+
+    def summary(self) -> str:
+        report = self.report()
+        width = max((len(name) for name in report['phases']), default=0)
+        width = max(width, len('total'))
+        lines = [f'{"phase":<{width}}  {"wall":>9}  {"cpu":>9}']
+        for name, phase in report['phases'].items():
+            lines.append(f'{name:<{width}}  {phase["wall_seconds"]:>8.3f}s  {phase["cpu_seconds"]:>8.3f}s')
+        lines.append(f'{"total":<{width}}  {report["wall_seconds"]:>8.3f}s  {report["cpu_seconds"]:>8.3f}s')
+        lines.extend(f'{name}: {value}' for name, value in report['counters'].items())
+        return '\n'.join(lines)
+
+
+class _SamplingProfiler:
+    """Samples the stack of the main thread every interval of CPU time.
+
+    The samples are written as collapsed stacks (one "frame;frame;... count"
+    line per distinct stack), which flamegraph.pl and speedscope can read.
+    Each stack starts with the build phases that were running, so hot spots
+    can be attributed to a phase.
+    """
+
+    def __init__(self, stats: BuildStats, interval: float = PROFILE_SAMPLE_INTERVAL) -> None:
+        self.stats = stats
+        self.interval = interval
+        self.samples: collections.Counter[str] = collections.Counter()
+
+    def __enter__(self) -> _SamplingProfiler:
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler)
+
+    def _sample(self, signum: int, frame: Any) -> None:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+            frame = frame.f_back
+        stack.extend(f'phase:{name}' for name in reversed(self.stats.active))
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def save(self, path: str) -> None:
+        with atomic_write(path) as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write(f'{stack} {count}\n')
+
+
+@contextlib.contextmanager
+def _profile(path: str, profile_format: str, stats: BuildStats) -> Generator[None]:
+    """Profile the block, writing a pstats file or collapsed stacks to path."""
+    if profile_format == 'pstats':
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+    else:
+        sampler = _SamplingProfiler(stats)
+        try:
+            with sampler:
+                yield
+        finally:
+            sampler.save(path)
+
+
 class Settings(NamedTuple):
     output_dir: str
     packages_url: str
@@ -296,16 +1276,21 @@ class Settings(NamedTuple):
     logo_width: int
     generate_timestamp: bool
     disable_per_release_json: bool
+    fast_simple_pages: bool = False
+    precompress: tuple[str, ...] = ()
+    search_index: bool = False
 
+    def output_digest(self) -> str:
+        """A digest of the settings which change the generated files."""
+        # The fast renderer's output is the same, and the output directory
+        # can be moved around.
+        settings = self._replace(output_dir='', fast_simple_pages=False)
+        return hashlib.blake2b(json.dumps(settings).encode(), digest_size=16).hexdigest()
 
-def build_repo(
-        packages: dict[str, set[Package]],
-        previous_packages: dict[str, set[Package]] | None,
-        settings: Settings,
-) -> None:
-    simple = os.path.join(settings.output_dir, 'simple')
-    pypi = os.path.join(settings.output_dir, 'pypi')
-    current_date = _format_datetime(datetime.utcnow())
+
+def _jinja_env(settings: Settings) -> jinja2.Environment:
+    # Imported here so that builds which turn out to be no-ops don't pay for it.
+    import jinja2
 
     jinja_env = jinja2.Environment(
         loader=jinja2.PackageLoader('dumb_pypi', 'templates'),
@@ -315,138 +1300,820 @@ def build_repo(
     jinja_env.globals['packages_url'] = settings.packages_url
     jinja_env.globals['logo'] = settings.logo
     jinja_env.globals['logo_width'] = settings.logo_width
+    return jinja_env
+
+
+def _stream_template(template: jinja2.Template, **context: Any) -> Iterable[str]:
+    """Render a template piece by piece, for pages listing every package.
+
+    The pieces are buffered into chunks of STREAM_BUFFER_SIZE template
+    nodes, so the page never has to be held in memory as one string.
+    """
+    stream = template.stream(**context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return stream
+
+
+def _escape(s: str) -> str:
+    """Escape s the same way as Jinja's autoescaping does."""
+    # Most strings (filenames, versions, hashes) need no escaping at all.
+    if NEEDS_ESCAPE_RE.search(s) is None:
+        return s
+    return (
+        s.replace('&', '&amp;')
+        .replace('>', '&gt;')
+        .replace('<', '&lt;')
+        .replace("'", '&#39;')
+        .replace('"', '&#34;')
+    )
 
-    # Short circuit if nothing changed at all.
-    if packages == previous_packages:
-        return
+
+# The fast renderers below produce exactly what simple.html and package.html
+# render to, whitespace included. They must be kept in sync with the templates.
+_FAST_TIMESTAMP = '\n            <p>Generated on {date}.</p>\n        '
+
+_FAST_SIMPLE_HEAD = """\
+<!doctype html>
+<html>
+    <head>
+        <title>Simple index</title>
+    </head>
+    <body>
+        <h1>Simple index</h1>
+        {timestamp}
+        <ul>
+            """
+_FAST_SIMPLE_ITEM = """
+                <li><a href="{package}/index.html">{package}</a></li>
+            """
+_FAST_SIMPLE_TAIL = """
+        </ul>
+    </body>
+</html>
+
+"""
+
+_FAST_PACKAGE_HEAD = """\
+<!doctype html>
+<html><head><title>Links for {package_name}</title></head><body>
+<h1>Links for {package_name}</h1>
+"""
+_FAST_PACKAGE_ITEM = '<a href="{url}"{attributes}>{filename}</a><br>\n'
+_FAST_PACKAGE_TAIL = '</body></html>'
+
+
+def _fast_timestamp(date: str, generate_timestamp: bool) -> str:
+    return _FAST_TIMESTAMP.format(date=_escape(date)) if generate_timestamp else ''
+
+
+def _fast_render_simple_index(
+        package_names: Iterable[str],
+        *,
+        date: str,
+        generate_timestamp: bool,
+) -> Generator[str]:
+    """Render /simple/index.html without Jinja (see simple.html)."""
+    yield _FAST_SIMPLE_HEAD.format(timestamp=_fast_timestamp(date, generate_timestamp))
+    item = _FAST_SIMPLE_ITEM.format
+    for chunk in _chunks(package_names, STREAM_BUFFER_SIZE):
+        yield ''.join([item(package=_escape(package_name)) for package_name in chunk])
+    yield _FAST_SIMPLE_TAIL
+
+
+def _fast_render_package(
+        package_name: str,
+        sorted_files: list[Package],
+        *,
+        packages_url: str,
+) -> str:
+    """Render /simple/{package}/index.html without Jinja (see package.html)."""
+    parts = [_FAST_PACKAGE_HEAD.format(package_name=_escape(package_name))]
+    item = _FAST_PACKAGE_ITEM.format
+    for file in reversed(sorted_files):
+        attributes = ''
+        if file.requires_python:
+            attributes += f' data-requires-python="{_escape(file.requires_python)}"'
+        if file.core_metadata:
+            attributes += f' data-core-metadata="{_escape(file.core_metadata)}"'
+        if file.yanked_reason:
+            attributes += f' data-yanked="{_escape(file.yanked_reason)}"'
+        parts.append(item(
+            url=_escape(file.url(packages_url)),
+            attributes=attributes,
+            filename=_escape(file.filename),
+        ))
+    parts.append(_FAST_PACKAGE_TAIL)
+    return ''.join(parts)
+
+
+class _PackageRenderer:
+    """Renders the pages for a single package.
+
+    This is what runs in the worker processes with --jobs, so it only
+    returns the (path, content) pairs to write, in the same order as a
+    serial build would write them.
+
+    With stats, the time spent rendering each kind of page is recorded.
+    """
+
+    def __init__(
+            self,
+            settings: Settings,
+            current_date: str,
+            jinja_env: jinja2.Environment | None = None,
+            stats: BuildStats | None = None,
+    ) -> None:
+        self.settings = settings
+        self.current_date = current_date
+        self.jinja_env = jinja_env if jinja_env is not None else _jinja_env(settings)
+        self.stats = stats
+
+    def _phase(self, name: str) -> contextlib.AbstractContextManager[None]:
+        return self.stats.phase(name) if self.stats is not None else contextlib.nullcontext()
+
+    def render(
+            self,
+            package_name: str,
+            sorted_files: list[Package],
+            changed_versions: frozenset[str | None],
+    ) -> Generator[tuple[str, str]]:
+        settings = self.settings
+        latest_version = sorted_files[-1].version
+
+        # /simple/{package}/index.html
+        with self._phase('render_simple_page'):
+            if settings.fast_simple_pages:
+                page = _fast_render_package(package_name, sorted_files, packages_url=settings.packages_url)
+            else:
+                page = self.jinja_env.get_template('package.html').render(
+                    package_name=package_name,
+                    files=sorted_files,
+                    packages_url=settings.packages_url,
+                )
+        yield f'simple/{package_name}/index.html', page
+
+        # /project/{package}/index.html
+        with self._phase('render_project_page'):
+            page = self.jinja_env.get_template('project.html').render(
+                date=self.current_date,
+                generate_timestamp=settings.generate_timestamp,
+                package_name=package_name,
+                files=sorted_files,
+                packages_url=settings.packages_url,
+                requirement=f'{package_name}=={latest_version}' if latest_version else package_name,
+            )
+        yield f'project/{package_name}/index.html', page
+
+        # /simple/{package}/index.json
+        with self._phase('render_simple_json'):
+            page = json.dumps(_simple_package_json(package_name, sorted_files, settings.packages_url))
+        yield f'simple/{package_name}/index.json', page
+
+        # /pypi/{package}/json
+        with self._phase('render_package_json'):
+            page = json.dumps(_package_json(sorted_files, settings.packages_url))
+        yield f'pypi/{package_name}/json', page
+
+        # /pypi/{package}/{version}/json
+        if not settings.disable_per_release_json:
+            for version, files in _files_by_version(sorted_files).items():
+                if version is None or version not in changed_versions:
+                    continue
+                with self._phase('render_release_json'):
+                    page = json.dumps(_package_json(files, settings.packages_url))
+                yield f'pypi/{package_name}/{version}/json', page
+
+    def render_packages(
+            self,
+            batch: list[tuple[str, list[Package], frozenset[str | None]]],
+    ) -> list[tuple[str, str]]:
+        return [
+            rendered
+            for package_name, sorted_files, changed_versions in batch
+            for rendered in self.render(package_name, sorted_files, changed_versions)
+        ]
+
+
+_worker_renderer: _PackageRenderer | None = None
+
+
+def _init_render_worker(settings: Settings, current_date: str) -> None:
+    global _worker_renderer
+    _worker_renderer = _PackageRenderer(settings, current_date)
+
+
+def _render_packages_in_worker(
+        batch: list[tuple[str, list[Package], frozenset[str | None]]],
+        collect_stats: bool = False,
+) -> tuple[list[tuple[str, str]], BuildStats | None]:
+    """Render a batch, also returning the stats for just this batch."""
+    assert _worker_renderer is not None
+    _worker_renderer.stats = BuildStats() if collect_stats else None
+    return _worker_renderer.render_packages(batch), _worker_renderer.stats
+
+
+def _prune(
+        output: OutputDirectory,
+        state: RepoState,
+        previous_state: RepoState | None,
+        settings: Settings,
+) -> None:
+    """Delete the per-package outputs of packages and versions not in state.
+
+    With the state of the previous build, only the packages removed since
+    then are deleted (the build itself deletes the pages of removed versions).
+    Otherwise, the whole output is scanned for them. The search index is
+    deleted too if it is turned off.
+    """
+    pruned_dirs = []
+
+    def delete_tree(path: str) -> None:
+        for dirpath, _, filenames in os.walk(os.path.join(output.path, path)):
+            pruned_dirs.append(dirpath)
+            for filename in filenames:
+                output.delete(os.path.relpath(os.path.join(dirpath, filename), output.path))
+
+    if previous_state is not None:
+        for package_name in sorted(previous_state.package_digests.keys() - state.package_digests.keys()):
+            for top in ('simple', 'project', 'pypi'):
+                delete_tree(os.path.join(top, package_name))
+    else:
+        for top in ('simple', 'project', 'pypi'):
+            try:
+                entries = sorted(os.scandir(os.path.join(output.path, top)), key=operator.attrgetter('name'))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if not entry.is_dir():
+                    continue
+                package_dir = os.path.join(top, entry.name)
+                if entry.name not in state.package_digests:
+                    delete_tree(package_dir)
+                elif top == 'pypi':
+                    # /pypi/{package}/{version}/json
+                    versions = () if settings.disable_per_release_json else state.release_digests[entry.name]
+                    for version_entry in os.scandir(entry.path):
+                        if version_entry.is_dir() and version_entry.name not in versions:
+                            delete_tree(os.path.join(package_dir, version_entry.name))
+    if not settings.search_index:
+        delete_tree('search')
+
+    # Deleting a file only removes the directory it was in, so wait for the
+    # deletions and then remove whatever is left empty above them.
+    output.flush()
+    for dirpath in reversed(pruned_dirs):
+        with contextlib.suppress(OSError):
+            os.rmdir(dirpath)
+
+
+def build_repo(
+        packages: dict[str, set[Package]],
+        previous_packages: dict[str, set[Package]] | None,
+        settings: Settings,
+        output: OutputSink | None = None,
+        previous_state: RepoState | None = None,
+        *,
+        jobs: int = 1,
+        prune: bool = False,
+        stats: BuildStats | None = None,
+) -> RepoState:
+    """Build the repository, returning the state to compare the next build to.
+
+    The previous build can be described either by its packages or by the
+    state it returned. Only the outputs which changed since then are written.
+
+    With prune, the pages of packages and versions which are no longer in the
+    input are deleted too. Without a previous build to compare to, the output
+    directory is scanned for them.
+
+    With stats, the time spent in each phase of the build (including the
+    rendering of each kind of page) and the number of files are recorded.
+    """
+    if output is None:
+        output = OutputDirectory(settings.output_dir, precompress=settings.precompress)
+    collect_stats = stats is not None
+    if stats is None:
+        stats = BuildStats()
+    current_date = _format_datetime(datetime.utcnow())
+
+    jinja_env = _jinja_env(settings)
+
+    with stats.phase('digest'):
+        packages = PackageIndex.from_packages(packages)
+    stats.count('packages', len(packages))
+    stats.count('files', sum(len(files) for files in packages.values()))
 
     # Sorting package versions is actually pretty expensive, so we do it once
-    # at the start.
-    sorted_packages = {name: sorted(files) for name, files in packages.items()}
+    # at the start. Sorting by key computes each sort_key once per file rather
+    # than twice per comparison.
+    with stats.phase('sort'):
+        sorted_packages = {
+            name: sorted(files, key=operator.attrgetter('sort_key'))
+            for name, files in packages.items()
+        }
+    with stats.phase('changelog_sort'):
+        changelog_pages = _changelog_pages(sorted_packages)
+    with stats.phase('digest'):
+        state = RepoState.create(packages, changelog_pages, settings)
+
+    if previous_state is None and previous_packages is not None:
+        with stats.phase('previous_digest'):
+            previous_packages = PackageIndex.from_packages(previous_packages)
+            # Unchanged packages have the same sorted files as now.
+            previous_sorted_packages = {
+                package_name: (
+                    sorted_packages[package_name]
+                    if packages.package_digests.get(package_name) == previous_packages.package_digests[package_name]
+                    else sorted(files, key=operator.attrgetter('sort_key'))
+                )
+                for package_name, files in previous_packages.items()
+            }
+            previous_state = RepoState.create(
+                previous_packages,
+                _changelog_pages(previous_sorted_packages),
+                settings,
+            )
+
+    # Every output can depend on the settings, so if they changed since the
+    # previous build, everything is rebuilt.
+    if previous_state is not None and previous_state.settings_digest != state.settings_digest:
+        previous_state = None
+
+    if prune:
+        if not isinstance(output, OutputDirectory):
+            raise ValueError('Pruning is only possible when writing to a directory')
+        with stats.phase('prune'):
+            _prune(output, state, previous_state, settings)
+
+    # Short circuit if nothing changed at all.
+    if previous_state is not None and state.digest == previous_state.digest:
+        with stats.phase('flush'):
+            output.flush()
+        stats.count_output(output)
+        return state
 
     # /simple/index.html
     # Rebuild if there are different package names.
-    if previous_packages is None or set(packages) != set(previous_packages):
-        os.makedirs(simple, exist_ok=True)
-        with atomic_write(os.path.join(simple, 'index.html')) as f:
-            f.write(jinja_env.get_template('simple.html').render(
-                date=current_date,
-                generate_timestamp=settings.generate_timestamp,
-                package_names=sorted(sorted_packages),
-            ))
-
-    for package_name, sorted_files in sorted_packages.items():
-        # Rebuild if the files are different for this package.
-        if previous_packages is None or previous_packages[package_name] != packages[package_name]:
-            latest_version = sorted_files[-1].version
-
-            # /simple/{package}/index.html
-            simple_package_dir = os.path.join(simple, package_name)
-            os.makedirs(simple_package_dir, exist_ok=True)
-            with atomic_write(os.path.join(simple_package_dir, 'index.html')) as f:
-                f.write(jinja_env.get_template('package.html').render(
+    if previous_state is None or state.package_digests.keys() != previous_state.package_digests.keys():
+        with stats.phase('simple_index'):
+            if settings.fast_simple_pages:
+                output.write('simple/index.html', _fast_render_simple_index(
+                    sorted(sorted_packages),
                     date=current_date,
                     generate_timestamp=settings.generate_timestamp,
-                    package_name=package_name,
-                    files=sorted_files,
-                    packages_url=settings.packages_url,
-                    requirement=f'{package_name}=={latest_version}' if latest_version else package_name,
+                ))
+            else:
+                output.write('simple/index.html', _stream_template(
+                    jinja_env.get_template('simple.html'),
+                    date=current_date,
+                    generate_timestamp=settings.generate_timestamp,
+                    package_names=sorted(sorted_packages),
                 ))
 
-            # /pypi/{package}/json
-            pypi_package_dir = os.path.join(pypi, package_name)
-            os.makedirs(pypi_package_dir, exist_ok=True)
-            with atomic_write(os.path.join(pypi_package_dir, 'json')) as f:
-                json.dump(_package_json(sorted_files, settings.packages_url), f)
-
-            # /pypi/{package}/{version}/json
-            if not settings.disable_per_release_json:
-                # TODO: Consider making this only generate JSON for the changed versions.
-                version_to_files = collections.defaultdict(list)
-                for file_ in sorted_files:
-                    version_to_files[file_.version].append(file_)
-                for version, files in version_to_files.items():
-                    if version is None:
-                        continue
-                    version_dir = os.path.join(pypi_package_dir, version)
-                    os.makedirs(version_dir, exist_ok=True)
-                    with atomic_write(os.path.join(version_dir, 'json')) as f:
-                        json.dump(_package_json(files, settings.packages_url), f)
+            # /simple/index.json
+            output.write('simple/index.json', _simple_index_json(sorted(sorted_packages)))
+
+    # Per-package pages, which are rendered in worker processes with --jobs.
+    with stats.phase('package_pages'):
+        changed_packages: list[tuple[str, list[Package], frozenset[str | None]]] = []
+        for package_name, sorted_files in sorted_packages.items():
+            # Rebuild if the files are different for this package.
+            if (
+                    previous_state is None or
+                    previous_state.package_digests.get(package_name) != state.package_digests[package_name]
+            ):
+                # Only versions whose files changed are rewritten, since a package
+                # can have thousands of releases but usually only gets a new one.
+                release_digests = state.release_digests[package_name]
+                previous_release_digests = (
+                    previous_state.release_digests.get(package_name, {})
+                    if previous_state is not None else {}
+                )
+                changed_versions = frozenset(
+                    version
+                    for version, digest in release_digests.items()
+                    if digest != previous_release_digests.get(version)
+                )
+                changed_packages.append((package_name, sorted_files, changed_versions))
+                if not settings.disable_per_release_json:
+                    for version in previous_release_digests.keys() - release_digests.keys():
+                        output.delete(f'pypi/{package_name}/{version}/json')
+
+        stats.count('changed_packages', len(changed_packages))
+        batches = _chunks(changed_packages, RENDER_CHUNK_SIZE)
+        if jobs > 1:
+            # The output's I/O threads may already be running, and forking a
+            # process with threads can deadlock, so the workers are started
+            # from a clean process instead.
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=jobs,
+                    mp_context=multiprocessing.get_context(start_method),
+                    initializer=_init_render_worker,
+                    initargs=(settings, current_date),
+            ) as executor:
+                for rendered, worker_stats in _map_in_pool(
+                        executor,
+                        functools.partial(_render_packages_in_worker, collect_stats=collect_stats),
+                        batches,
+                        max_pending=jobs * 2,
+                ):
+                    if worker_stats is not None:
+                        stats.merge(worker_stats)
+                    for path, content in rendered:
+                        output.write(path, content)
+        else:
+            renderer = _PackageRenderer(settings, current_date, jinja_env, stats if collect_stats else None)
+            for batch in batches:
+                for path, content in renderer.render_packages(batch):
+                    output.write(path, content)
 
     # /changelog
-    # Always rebuild (we would have short circuited already if nothing changed).
-    changelog = os.path.join(settings.output_dir, 'changelog')
-    os.makedirs(changelog, exist_ok=True)
-    files_newest_first = sorted(
-        itertools.chain.from_iterable(packages.values()),
-        key=lambda package: (-(package.upload_timestamp or 0), package),
-    )
-    page_count = math.ceil(len(files_newest_first) / CHANGELOG_ENTRIES_PER_PAGE)
-    for page_idx, start_idx in enumerate(range(0, len(files_newest_first), CHANGELOG_ENTRIES_PER_PAGE)):
-        chunk = files_newest_first[start_idx:start_idx + CHANGELOG_ENTRIES_PER_PAGE]
-        page_number = page_idx + 1
-        with atomic_write(os.path.join(changelog, f'page{page_number}.html')) as f:
-            pagination_first = "page1.html" if page_number != 1 else None
-            pagination_last = f"page{page_count}.html" if page_number != page_count else None
-            pagination_prev = f"page{page_number - 1}.html" if page_number != 1 else None
-            pagination_next = f"page{page_number + 1}.html" if page_number != page_count else None
-            f.write(jinja_env.get_template('changelog.html').render(
+    # Only rebuild the pages whose files or links changed.
+    with stats.phase('changelog'):
+        previous_changelog_digests = previous_state.changelog_digests if previous_state is not None else []
+        page_count = len(changelog_pages)
+        previous_page_count = len(previous_changelog_digests)
+        for page_idx, chunk in enumerate(changelog_pages):
+            page_number = page_idx + 1
+            # A page's links only depend on whether it is the newest page.
+            links_changed = page_count != previous_page_count and page_number in (page_count, previous_page_count)
+            if (
+                    page_idx < previous_page_count and
+                    state.changelog_digests[page_idx] == previous_changelog_digests[page_idx] and
+                    not links_changed
+            ):
+                continue
+            content = jinja_env.get_template('changelog.html').render(
                 files_newest_first=chunk,
                 page_number=page_number,
-                page_count=page_count,
-                pagination_first=pagination_first,
-                pagination_last=pagination_last,
-                pagination_prev=pagination_prev,
-                pagination_next=pagination_next,
-            ))
+                pagination_first="latest.html" if page_number != page_count else None,
+                pagination_prev=f"page{page_number + 1}.html" if page_number != page_count else None,
+                pagination_next=f"page{page_number - 1}.html" if page_number != 1 else None,
+                pagination_last="page1.html" if page_number != 1 else None,
+            )
+            output.write(f'changelog/page{page_number}.html', content)
+            if page_number == page_count:
+                output.write('changelog/latest.html', content)
+        for page_number in range(page_count + 1, previous_page_count + 1):
+            output.delete(f'changelog/page{page_number}.html')
+
+    # /search/{prefix}.json
+    if settings.search_index:
+        with stats.phase('search_index'):
+            shards: dict[str, list[str]] = collections.defaultdict(list)
+            for package_name in sorted(sorted_packages):
+                shards[_search_prefix(package_name)].append(package_name)
+
+            # Only rebuild the shards with added, removed or changed packages.
+            if previous_state is None:
+                changed_prefixes = set(shards)
+            else:
+                changed_prefixes = {
+                    _search_prefix(package_name)
+                    for package_name in state.package_digests.keys() | previous_state.package_digests.keys()
+                    if state.package_digests.get(package_name) != previous_state.package_digests.get(package_name)
+                }
+            for prefix in sorted(changed_prefixes):
+                if prefix in shards:
+                    output.write(f'search/{prefix}.json', json.dumps(
+                        [
+                            [package_name, sorted_packages[package_name][-1].version]
+                            for package_name in shards[prefix]
+                        ],
+                        separators=(',', ':'),
+                    ))
+                else:
+                    output.delete(f'search/{prefix}.json')
+
+            # /search/index.json
+            if previous_state is None or state.package_digests.keys() != previous_state.package_digests.keys():
+                output.write('search/index.json', json.dumps({
+                    'total': len(sorted_packages),
+                    'shards': {prefix: len(package_names) for prefix, package_names in shards.items()},
+                }, separators=(',', ':')))
 
     # /index.html
     # Always rebuild (we would have short circuited already if nothing changed).
-    with atomic_write(os.path.join(settings.output_dir, 'index.html')) as f:
-        f.write(jinja_env.get_template('index.html').render(
-            packages=sorted(
+    # With the search index, the packages are loaded from there instead.
+    with stats.phase('root_index'):
+        output.write('index.html', _stream_template(
+            jinja_env.get_template('index.html'),
+            search_index=settings.search_index,
+            search_max_results=SEARCH_MAX_RESULTS,
+            packages=(
                 (
                     package,
-                    sorted_versions[-1].version,
+                    sorted_packages[package][-1].version,
                 )
-                for package, sorted_versions in sorted_packages.items()
-            ),
+                for package in sorted(sorted_packages)
+            ) if not settings.search_index else (),
         ))
 
     # /packages.json
     # Always rebuild (we would have short circuited already if nothing changed).
-    with atomic_write(os.path.join(settings.output_dir, 'packages.json')) as f:
-        for package in itertools.chain.from_iterable(sorted_packages.values()):
-            f.write(f'{json.dumps(package.input_json())}\n')
+    with stats.phase('packages_json'):
+        output.write('packages.json', (
+            f'{json.dumps(package.input_json())}\n'
+            for package in itertools.chain.from_iterable(sorted_packages.values())
+        ))
 
+    # Everything must be on disk before the caller saves the new state.
+    with stats.phase('flush'):
+        output.flush()
+    stats.count_output(output)
+    return state
 
-def _lines_from_path(path: str) -> list[str]:
-    f = sys.stdin if path == '-' else open(path)
-    return f.read().splitlines()
+
+def _output_target(args: argparse.Namespace) -> str:
+    """Where a build writes its output, as recorded in its state."""
+    if args.archive is not None:
+        return f'archive:{os.path.abspath(args.archive)}'
+    elif args.generations:
+        return 'generations'
+    else:
+        return 'directory'
+
+
+def _input_fingerprint(input_option: str, path: str, settings: Settings, output_target: str) -> str:
+    """Fingerprint of everything which determines the output of a build."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([STATE_VERSION, input_option, settings._asdict(), output_target]).encode())
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _generation_numbers(output_dir: str) -> list[int]:
+    try:
+        names = os.listdir(os.path.join(output_dir, GENERATIONS_DIR))
+    except FileNotFoundError:
+        return []
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+def _current_generation(output_dir: str) -> str | None:
+    """Path of the generation the current symlink points at, if any."""
+    link = os.path.join(output_dir, CURRENT_GENERATION)
+    if not os.path.islink(link):
+        return None
+    return os.path.join(output_dir, os.readlink(link))
+
+
+def _start_generation(output_dir: str) -> str:
+    """Create the next generation directory and return its path.
+
+    It starts as a copy of the current generation made of hard links, so
+    files which this build doesn't change cost nothing to carry over.
+    atomic_write replaces files rather than writing into them, so writing
+    to the new generation never changes the files of the current one.
+    """
+    current = _current_generation(output_dir)
+    current_number = int(os.path.basename(current)) if current is not None else 0
+    # Anything newer than the current generation is left over from a build
+    # which failed.
+    for number in _generation_numbers(output_dir):
+        if number > current_number:
+            shutil.rmtree(os.path.join(output_dir, GENERATIONS_DIR, str(number)))
+
+    path = os.path.join(output_dir, GENERATIONS_DIR, str(current_number + 1))
+    if current is not None and os.path.isdir(current):
+        shutil.copytree(current, path, symlinks=True, copy_function=os.link)
+    else:
+        os.makedirs(path)
+    return path
+
+
+def _switch_generation(output_dir: str, generation: str, *, keep: int) -> None:
+    """Atomically point the current symlink at generation.
+
+    Then delete all but the newest `keep` generations.
+    """
+    link = os.path.join(output_dir, CURRENT_GENERATION)
+    if os.path.lexists(link) and not os.path.islink(link):
+        raise ValueError(f'Refusing to replace {link}, which is not a symlink')
+    tmp_link = tempfile.mktemp(prefix=f'.{CURRENT_GENERATION}', dir=output_dir)
+    os.symlink(os.path.relpath(generation, output_dir), tmp_link)
+    os.replace(tmp_link, link)
+
+    # The current generation counts towards `keep`.
+    current_number = int(os.path.basename(generation))
+    older = [number for number in _generation_numbers(output_dir) if number < current_number]
+    for number in older[:max(len(older) - (keep - 1), 0)]:
+        shutil.rmtree(os.path.join(output_dir, GENERATIONS_DIR, str(number)))
+
+
+def _read_fingerprint(path: str) -> str | None:
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _lines_from_path(path: str) -> Generator[str]:
+    """Yield lines from the file at path (or stdin) without reading it all.
+
+    Lines are parsed as soon as they are read, so a producer writing into a
+    pipe overlaps with parsing and the raw text is never held in memory.
+    """
+    with contextlib.ExitStack() as ctx:
+        f = sys.stdin if path == '-' else ctx.enter_context(open(path))
+        for line in f:
+            yield line.rstrip('\r\n')
+
+
+def _chunks(iterable: Iterable[T], size: int) -> Generator[list[T]]:
+    it = iter(iterable)
+    while chunk := list(itertools.islice(it, size)):
+        yield chunk
+
+
+def _map_in_pool(
+        executor: concurrent.futures.Executor,
+        fn: Callable[[T], U],
+        iterable: Iterable[T],
+        *,
+        max_pending: int,
+) -> Generator[U]:
+    """Like executor.map, but results come back in order and only
+    max_pending items are submitted ahead of the consumer.
+
+    (Executor.map submits everything up front, which would defeat streaming
+    the input.)
+    """
+    pending: collections.deque[concurrent.futures.Future[U]] = collections.deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _create_packages_chunk(
+        args: tuple[list[dict[str, Any]], ParseCache | None],
+) -> tuple[list[tuple[Package, int]], list[str]]:
+    package_infos, parse_cache = args
+    packages = []
+    errors = []
+    for package_info in package_infos:
+        try:
+            package = Package.create(**package_info, parse_cache=parse_cache)
+            packages.append((package, _digest_package(package)))
+        except ValueError as ex:
+            errors.append(f'{ex} (skipping package)')
+    return packages, errors
 
 
 def _create_packages(
-        package_infos: Iterator[dict[str, Any]],
-) -> dict[str, set[Package]]:
-    packages: dict[str, set[Package]] = collections.defaultdict(set)
+        package_infos: Iterable[dict[str, Any]],
+        *,
+        jobs: int = 1,
+        parse_cache: ParseCache | None = None,
+) -> PackageIndex:
+    packages = PackageIndex()
+    if jobs > 1:
+        # Workers only get the cache entries relevant to their chunk, and
+        # we record what they parsed back into our copy of the cache.
+        chunks = (
+            (
+                chunk,
+                parse_cache.subset(info['filename'] for info in chunk if 'filename' in info)
+                if parse_cache is not None else None,
+            )
+            for chunk in _chunks(package_infos, PARSE_CHUNK_SIZE)
+        )
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = _map_in_pool(
+                executor,
+                _create_packages_chunk,
+                chunks,
+                max_pending=jobs * 2,
+            )
+            for chunk_packages, errors in results:
+                for error in errors:
+                    print(error, file=sys.stderr)
+                for package, digest in chunk_packages:
+                    packages.add(package, digest)
+                    if parse_cache is not None:
+                        parse_cache.remember(package)
+        return packages
+
     for package_info in package_infos:
         try:
-            package = Package.create(**package_info)
+            package = Package.create(**package_info, parse_cache=parse_cache)
         except ValueError as ex:
             # TODO: this should really be optional; i'd prefer it to fail hard
             print(f'{ex} (skipping package)', file=sys.stderr)
         else:
-            packages[package.name].add(package)
+            packages.add(package)
 
     return packages
 
 
-def package_list(path: str) -> dict[str, set[Package]]:
-    return _create_packages({'filename': line} for line in _lines_from_path(path))
+# The JSON types of the keys which delta events can have (besides "action").
+_DELTA_EVENT_TYPES: dict[str, type] = {
+    'filename': str,
+    'hash': str,
+    'requires_dist': list,
+    'requires_python': str,
+    'upload_timestamp': int,
+    'uploaded_by': str,
+    'yanked_reason': str,
+    'core_metadata': str,
+    'size': int,
+}
+
+
+def _apply_delta_event(packages: PackageIndex, event: Any) -> None:
+    if not isinstance(event, dict):
+        raise ValueError(f'Delta event is not a JSON object: {event!r}')
+    event = dict(event)
+    action = event.pop('action', None)
+    filename = event.get('filename')
+    if not isinstance(filename, str):
+        raise ValueError(f'Delta event without a filename: {event}')
+    for key, value in event.items():
+        expected_type = _DELTA_EVENT_TYPES.get(key)
+        if expected_type is None:
+            raise ValueError(f'Unknown key {key!r} in delta event for {filename}')
+        if value is not None and (not isinstance(value, expected_type) or isinstance(value, bool)):
+            raise ValueError(f'Invalid {key} in delta event for {filename}: {value!r}')
+    if not all(isinstance(requirement, str) for requirement in event.get('requires_dist') or ()):
+        raise ValueError(f'Invalid requires_dist in delta event for {filename}: {event["requires_dist"]!r}')
+    existing = packages.find(filename)
+
+    if action in ('add', 'update'):
+        if action == 'update' and existing is None:
+            raise ValueError(f'Cannot update unknown file: {filename}')
+        package = Package.create(**event)
+        if existing is not None:
+            packages.remove(existing)
+        packages.add(package)
+    elif action in ('remove', 'yank'):
+        if existing is None:
+            raise ValueError(f'Cannot {action} unknown file: {filename}')
+        if action == 'yank' and not event.get('yanked_reason'):
+            raise ValueError(f'Yank event without a yanked_reason: {filename}')
+        packages.remove(existing)
+        if action == 'yank':
+            packages.add(existing._replace(yanked_reason=event['yanked_reason']))
+    else:
+        raise ValueError(f'Unknown delta action {action!r} for {filename}')
+
+
+def apply_delta(packages: PackageIndex, path: str) -> PackageIndex:
+    """Return a copy of packages with the events in path applied.
+
+    Each line of the file is a JSON object with an "action" of "add",
+    "update" (both take the same keys as --package-list-json), "remove", or
+    "yank" (which takes a "yanked_reason"). Invalid events, and events which
+    don't apply (e.g. removing an unknown file), are skipped with a warning.
+    """
+    packages = packages.copy()
+    for line in _lines_from_path(path):
+        try:
+            _apply_delta_event(packages, json.loads(line))
+        except ValueError as ex:
+            print(f'{ex} (skipping event)', file=sys.stderr)
+    return packages
 
 
-def package_list_json(path: str) -> dict[str, set[Package]]:
-    return _create_packages(json.loads(line) for line in _lines_from_path(path))
+def package_list(
+        path: str,
+        *,
+        jobs: int = 1,
+        parse_cache: ParseCache | None = None,
+) -> PackageIndex:
+    return _create_packages(
+        ({'filename': line} for line in _lines_from_path(path)),
+        jobs=jobs,
+        parse_cache=parse_cache,
+    )
+
+
+def package_list_json(
+        path: str,
+        *,
+        jobs: int = 1,
+        parse_cache: ParseCache | None = None,
+) -> PackageIndex:
+    return _create_packages(
+        (json.loads(line) for line in _lines_from_path(path)),
+        jobs=jobs,
+        parse_cache=parse_cache,
+    )
+
+
+def _report_stats(stats: BuildStats, path: str | None, *, summary: bool) -> None:
+    if path is not None:
+        with atomic_write(path) as f:
+            json.dump(stats.report(), f, indent=2)
+            f.write('\n')
+    if summary:
+        print(stats.summary(), file=sys.stderr)
 
 
 def main(argv: Sequence[str] | None = None) -> int:
@@ -459,28 +2126,35 @@ def main(argv: Sequence[str] | None = None) -> int:
     package_input_group.add_argument(
         '--package-list',
         help='path to a list of packages (one per line)',
-        type=package_list,
-        dest='packages',
     )
     package_input_group.add_argument(
         '--package-list-json',
         help='path to a list of packages (one JSON object per line)',
-        type=package_list_json,
-        dest='packages',
+    )
+    package_input_group.add_argument(
+        '--apply-delta',
+        help=(
+            'path to a list of add/update/remove/yank events (one JSON object\n'
+            'per line) to apply to the packages.json of the last build'
+        ),
     )
 
     previous_package_input_group = parser.add_mutually_exclusive_group(required=False)
     previous_package_input_group.add_argument(
         '--previous-package-list',
         help='path to the previous list of packages (for partial rebuilds)',
-        type=package_list,
-        dest='previous_packages',
     )
     previous_package_input_group.add_argument(
         '--previous-package-list-json',
         help='path to the previous list of packages (for partial rebuilds)',
-        type=package_list_json,
-        dest='previous_packages',
+    )
+    previous_package_input_group.add_argument(
+        '--incremental',
+        action='store_true',
+        help=(
+            'Rebuild only changed packages by comparing with the state saved\n'
+            'in the output directory by the last --incremental build.'
+        ),
     )
 
     parser.add_argument(
@@ -519,8 +2193,159 @@ def main(argv: Sequence[str] | None = None) -> int:
             'a huge number of files for little benefit as almost no tools use it.'
         ),
     )
+    parser.add_argument(
+        '--jobs', type=int, default=1,
+        help='number of processes to use for parsing and rendering (default: 1)',
+    )
+    parser.add_argument(
+        '--parse-cache',
+        action='store_true',
+        help=(
+            'Cache the names and versions parsed from filenames in the output\n'
+            'directory, so that later runs only need to parse new filenames.'
+        ),
+    )
+    parser.add_argument(
+        '--skip-unchanged',
+        action='store_true',
+        help=(
+            "Don't rewrite output files whose contents haven't changed. This\n"
+            'keeps their mtimes stable for tools which sync the output.'
+        ),
+    )
+    parser.add_argument(
+        '--search-index',
+        action='store_true',
+        help=(
+            'write a search index split by name prefix, and have the root page\n'
+            'search it instead of listing every package'
+        ),
+    )
+    parser.add_argument(
+        '--fast-simple-pages',
+        action='store_true',
+        help=(
+            'render the /simple/ pages with a built-in renderer instead of\n'
+            'the Jinja templates; the output is the same, just faster'
+        ),
+    )
+    parser.add_argument(
+        '--io-threads', type=int,
+        help=(
+            'number of threads writing output files in the background while\n'
+            'pages are rendered (default: 0 to write synchronously, or one per\n'
+            'CPU with --precompress)'
+        ),
+    )
+    parser.add_argument(
+        '--precompress',
+        type=lambda value: tuple(fmt.strip() for fmt in value.split(',')),
+        default=(),
+        help=(
+            'comma-separated compression formats (gzip, brotli) to also write\n'
+            'next to every output file, e.g. index.html.gz, for nginx\n'
+            'gzip_static and brotli_static'
+        ),
+    )
+    parser.add_argument(
+        '--manifest',
+        help=(
+            'write a JSON line for every file created, updated or deleted by\n'
+            'this build to the given path, for publishing only what changed'
+        ),
+    )
+    parser.add_argument(
+        '--prune',
+        action='store_true',
+        help=(
+            'delete the pages of packages and versions which are no longer in\n'
+            'the input (this scans the output directory)'
+        ),
+    )
+    parser.add_argument(
+        '--generations',
+        action='store_true',
+        help=(
+            'build each version of the site into its own directory under\n'
+            f'{GENERATIONS_DIR} in the output directory, and switch the\n'
+            f'{CURRENT_GENERATION!r} symlink to it once it is complete'
+        ),
+    )
+    parser.add_argument(
+        '--keep-generations', type=int, default=2,
+        help='number of generations to keep, including the current one (default: 2)',
+    )
+    parser.add_argument(
+        '--archive',
+        help=(
+            'write the generated files into this tar archive (.tar, .tar.gz or\n'
+            '.tar.zst) instead of into the output directory, which is still\n'
+            'used for state; deleted paths are listed in the archive as\n'
+            f'{TarSink.DELETED_MEMBER}'
+        ),
+    )
+    parser.add_argument(
+        '--stats-json',
+        help=(
+            'write the wall and CPU time of each phase of the build, and the\n'
+            'numbers of packages and files processed, to this path as JSON'
+        ),
+    )
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help='print a summary of the phase times and counters to stderr',
+    )
+    parser.add_argument(
+        '--profile',
+        help=(
+            'profile parsing the package lists and building the repository,\n'
+            'writing the result to this path'
+        ),
+    )
+    parser.add_argument(
+        '--profile-format', choices=('pstats', 'collapsed'), default='pstats',
+        help=(
+            'pstats for a cProfile file (for pstats or snakeviz), or collapsed\n'
+            'for sampled stacks prefixed with the build phase (for flamegraph.pl\n'
+            'or speedscope) (default: pstats)'
+        ),
+    )
     args = parser.parse_args(argv)
-
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    archive_compression = None
+    if args.archive is not None:
+        for suffixes, archive_compression in ARCHIVE_SUFFIXES.items():
+            if args.archive.endswith(suffixes):
+                break
+        else:
+            parser.error(f'--archive must end with one of: {", ".join(itertools.chain(*ARCHIVE_SUFFIXES))}')
+        if archive_compression == 'zst' and importlib.util.find_spec('zstandard') is None:
+            parser.error('--archive with zstd needs the zstandard package (pip install dumb-pypi[zstd])')
+        for option in ('generations', 'prune', 'precompress', 'manifest', 'skip_unchanged', 'io_threads'):
+            if getattr(args, option):
+                parser.error(f'--archive can not be used with --{option.replace("_", "-")}')
+    if args.profile_format == 'collapsed' and (
+            not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread()
+    ):
+        parser.error('--profile-format collapsed needs SIGPROF, so only works on Unix in the main thread')
+    if args.keep_generations < 1:
+        parser.error('--keep-generations must be at least 1')
+    current_link = os.path.join(args.output_dir, CURRENT_GENERATION)
+    if args.generations and os.path.lexists(current_link) and not os.path.islink(current_link):
+        parser.error(f'--generations needs {current_link} to be a symlink (or not exist)')
+    if args.io_threads is None:
+        args.io_threads = (os.cpu_count() or 1) if args.precompress else 0
+    elif args.io_threads < 0:
+        parser.error('--io-threads must not be negative')
+    for fmt in args.precompress:
+        if fmt not in PRECOMPRESS_FORMATS:
+            parser.error(f'unknown --precompress format: {fmt} (choose from {", ".join(PRECOMPRESS_FORMATS)})')
+    if 'brotli' in args.precompress and importlib.util.find_spec('brotli') is None:
+        parser.error('--precompress brotli needs the brotli package (pip install dumb-pypi[brotli])')
+
+    stats = BuildStats()
     settings = Settings(
         output_dir=args.output_dir,
         packages_url=args.packages_url,
@@ -529,8 +2354,142 @@ def main(argv: Sequence[str] | None = None) -> int:
         logo_width=args.logo_width,
         generate_timestamp=args.generate_timestamp,
         disable_per_release_json=args.no_per_release_json,
+        fast_simple_pages=args.fast_simple_pages,
+        precompress=args.precompress,
+        search_index=args.search_index,
     )
-    build_repo(args.packages, args.previous_packages, settings)
+
+    # If the input is the same as for the last successful build, the output
+    # is already up to date and we can stop before doing any real work.
+    fingerprint_path = os.path.join(args.output_dir, STATE_DIR, 'fingerprint')
+    fingerprint = None
+    output_target = _output_target(args)
+    if args.package_list is not None:
+        input_option, input_path = '--package-list', args.package_list
+    elif args.package_list_json is not None:
+        input_option, input_path = '--package-list-json', args.package_list_json
+    else:
+        input_option, input_path = '--apply-delta', args.apply_delta
+    if args.incremental and input_path != '-':
+        with stats.phase('fingerprint'):
+            fingerprint = _input_fingerprint(input_option, input_path, settings, output_target)
+        if _read_fingerprint(fingerprint_path) == fingerprint:
+            # Nothing changed, and the manifest or archive should say so.
+            if args.manifest is not None:
+                with atomic_write(args.manifest):
+                    pass
+            if args.archive is not None:
+                TarSink(args.archive, compression=archive_compression).close()
+            stats.count('up_to_date')
+            _report_stats(stats, args.stats_json, summary=args.stats)
+            return 0
+
+    # The directory with the output of the last build.
+    site_dir = os.path.join(args.output_dir, CURRENT_GENERATION) if args.generations else args.output_dir
+    # Builds skipped because the input fingerprint matched aren't profiled.
+    with (
+            _profile(args.profile, args.profile_format, stats)
+            if args.profile is not None else contextlib.nullcontext()
+    ):
+        with stats.phase('parse'):
+            parse_cache_path = os.path.join(args.output_dir, STATE_DIR, 'parse-cache')
+            parse_cache = ParseCache.load(parse_cache_path) if args.parse_cache else None
+            load_list = functools.partial(package_list, jobs=args.jobs, parse_cache=parse_cache)
+            load_list_json = functools.partial(package_list_json, jobs=args.jobs, parse_cache=parse_cache)
+
+            previous_packages = None
+            if args.previous_package_list is not None:
+                previous_packages = load_list(args.previous_package_list)
+            elif args.previous_package_list_json is not None:
+                previous_packages = load_list_json(args.previous_package_list_json)
+
+            if args.package_list is not None:
+                packages = load_list(args.package_list)
+            elif args.package_list_json is not None:
+                packages = load_list_json(args.package_list_json)
+            else:
+                previous_list_path = os.path.join(site_dir, 'packages.json')
+                if not os.path.exists(previous_list_path):
+                    parser.error(f'--apply-delta needs the packages.json of a previous build: {previous_list_path}')
+                base_packages = load_list_json(previous_list_path)
+                packages = apply_delta(base_packages, args.apply_delta)
+                if previous_packages is None:
+                    previous_packages = base_packages
+
+            if parse_cache is not None:
+                parse_cache.save(parse_cache_path)
+
+        state_path = os.path.join(args.output_dir, STATE_DIR, 'state.json')
+        with stats.phase('load_state'):
+            saved_state = RepoState.load(state_path)
+        if saved_state is not None and saved_state.output != output_target:
+            # The last build was written somewhere else (e.g. into an archive
+            # instead of the directory), so neither its state nor the previous
+            # package list describe what is there now.
+            saved_state = previous_packages = None
+        previous_state = saved_state if args.incremental else None
+        if previous_packages is not None and (
+                saved_state.settings_digest != settings.output_digest() if saved_state is not None
+                else os.path.exists(os.path.join(site_dir, 'packages.json'))
+        ):
+            # The existing output was written by an older version of dumb-pypi
+            # (which may have laid it out differently) or with other settings,
+            # so only updating what changed in the package list isn't enough.
+            print('The existing output needs a full rebuild, ignoring the previous package list.', file=sys.stderr)
+            previous_packages = None
+        generation = None
+        if args.generations:
+            if _current_generation(args.output_dir) is None:
+                # The first generation starts out empty, so it needs everything.
+                previous_packages = previous_state = None
+            with stats.phase('generations'):
+                generation = _start_generation(args.output_dir)
+        with contextlib.ExitStack() as ctx:
+            manifest = ctx.enter_context(atomic_write(args.manifest)) if args.manifest is not None else None
+            output: OutputSink
+            if args.archive is not None:
+                output = ctx.enter_context(TarSink(args.archive, compression=archive_compression))
+            else:
+                output = ctx.enter_context(OutputDirectory(
+                    generation if generation is not None else args.output_dir,
+                    skip_unchanged=args.skip_unchanged,
+                    io_threads=args.io_threads,
+                    precompress=settings.precompress,
+                    manifest=manifest,
+                ))
+            state = build_repo(
+                packages,
+                previous_packages,
+                settings,
+                output,
+                previous_state,
+                jobs=args.jobs,
+                prune=args.prune,
+                stats=stats,
+            )
+            # Closing waits for the I/O threads, or finishes the archive.
+            with stats.phase('close_output'):
+                output.close()
+        if generation is not None:
+            with stats.phase('generations'):
+                _switch_generation(args.output_dir, generation, keep=args.keep_generations)
+        # Every build saves its state, even when it wasn't compared against
+        # (or didn't come from) a saved one, so that the state always
+        # describes the current output.
+        with stats.phase('save_state'):
+            state._replace(output=output_target).save(state_path)
+            if fingerprint is not None:
+                with atomic_write(fingerprint_path) as f:
+                    f.write(fingerprint)
+            else:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(fingerprint_path)
+    if args.skip_unchanged:
+        print(
+            f'Wrote {output.written} files, skipped {output.skipped} unchanged files.',
+            file=sys.stderr,
+        )
+    _report_stats(stats, args.stats_json, summary=args.stats)
     return 0
 
 
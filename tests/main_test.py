@@ -1,13 +1,35 @@
 from __future__ import annotations
 
+import concurrent.futures
+import gzip
+import io
 import json
+import os
+import pstats
 import re
+import signal
+import subprocess
+import sys
+import tarfile
+import time
+from typing import Any
 
 import pytest
 
 from dumb_pypi import main
 
 
+SETTINGS = main.Settings(
+    output_dir='unused',
+    packages_url='../../pool/',
+    title='My Private PyPI',
+    logo='https://i.imgur.com/DSrTMZJ.png',
+    logo_width=42,
+    generate_timestamp=True,
+    disable_per_release_json=False,
+)
+
+
 @pytest.mark.parametrize(
     ('s', 'expected'),
     (
@@ -161,6 +183,68 @@ def test_package_info_minimal_info():
     }
 
 
+def test_package_simple_json_info_all_info():
+    package = main.Package.create(
+        filename='f-1.0.tar.gz',
+        hash='sha256=deadbeef',
+        requires_python='>=3.6',
+        core_metadata='sha256=badc0ffee',
+        upload_timestamp=1528586805,
+        yanked_reason='Wrong Python Pinning',
+        size=1234,
+    )
+    assert package.simple_json_info('/prefix') == {
+        'filename': 'f-1.0.tar.gz',
+        'url': '/prefix/f-1.0.tar.gz',
+        'hashes': {'sha256': 'deadbeef'},
+        'requires-python': '>=3.6',
+        'core-metadata': {'sha256': 'badc0ffee'},
+        'dist-info-metadata': {'sha256': 'badc0ffee'},
+        'yanked': 'Wrong Python Pinning',
+        'upload-time': '2018-06-09T23:26:45Z',
+        'size': 1234,
+    }
+
+
+def test_package_simple_json_info_minimal_info():
+    package = main.Package.create(filename='f-1.0.tar.gz', core_metadata='true')
+    assert package.simple_json_info('/prefix') == {
+        'filename': 'f-1.0.tar.gz',
+        'url': '/prefix/f-1.0.tar.gz',
+        'hashes': {},
+        'core-metadata': True,
+        'dist-info-metadata': True,
+        'yanked': False,
+    }
+
+
+def test_simple_package_json():
+    files = [
+        main.Package.create(filename='f-1.0.tar.gz', size=1),
+        main.Package.create(filename='f-1.0-py3-none-any.whl', size=2),
+        main.Package.create(filename='f-2.0.tar.gz', size=3),
+    ]
+    ret = main._simple_package_json('f', sorted(files), '/prefix')
+    assert ret['meta'] == {'api-version': '1.1'}
+    assert ret['name'] == 'f'
+    assert ret['versions'] == ['1.0', '2.0']
+    assert [f['filename'] for f in ret['files']] == ['f-1.0-py3-none-any.whl', 'f-1.0.tar.gz', 'f-2.0.tar.gz']
+
+    # Without sizes for every file, the page can only claim version 1.0.
+    files.append(main.Package.create(filename='f-3.0.tar.gz'))
+    assert main._simple_package_json('f', sorted(files), '/prefix')['meta'] == {'api-version': '1.0'}
+
+
+@pytest.mark.parametrize('package_names', ([], ['a'], ['a', 'b', 'c"d']))
+def test_simple_index_json(package_names, monkeypatch):
+    monkeypatch.setattr(main, 'STREAM_BUFFER_SIZE', 2)
+    ret = ''.join(main._simple_index_json(package_names))
+    assert ret == json.dumps({
+        'meta': {'api-version': '1.1'},
+        'projects': [{'name': name} for name in package_names],
+    })
+
+
 def test_input_json_all_info():
     package = main.Package.create(
         filename='f-1.0.tar.gz',
@@ -171,6 +255,7 @@ def test_input_json_all_info():
         uploaded_by='asottile',
         upload_timestamp=1528586805,
         yanked_reason='Wrong Python Pinning',
+        size=1234,
     )
 
     assert package.input_json() == {
@@ -182,6 +267,7 @@ def test_input_json_all_info():
         'uploaded_by': 'asottile',
         'upload_timestamp': 1528586805,
         'yanked_reason': 'Wrong Python Pinning',
+        'size': 1234,
     }
     assert main.Package.create(**package.input_json()) == package
 
@@ -192,6 +278,18 @@ def test_input_json_minimal():
     assert main.Package.create(**package.input_json()) == package
 
 
+def test_package_create_interns_repeated_strings():
+    a, b = (
+        main.Package.create(**json.loads(line))
+        for line in (
+            '{"filename": "a-1.tar.gz", "uploaded_by": "ckuehl", "requires_python": ">=3.10"}',
+            '{"filename": "b-1.tar.gz", "uploaded_by": "ckuehl", "requires_python": ">=3.10"}',
+        )
+    )
+    assert a.uploaded_by is b.uploaded_by
+    assert a.requires_python is b.requires_python
+
+
 def test_package_json_excludes_non_versioned_packages():
     pkgs = [main.Package.create(filename='f.tar.gz')]
     ret = main._package_json(pkgs, '/prefix')
@@ -309,6 +407,41 @@ def test_build_repo_smoke_test(tmpdir):
     assert tmpdir.join('simple', 'ocflib', 'index.html').check(file=True)
     assert tmpdir.join('pypi', 'ocflib', 'json').check(file=True)
     assert tmpdir.join('pypi', 'ocflib', '2016.12.10.1.48', 'json').check(file=True)
+    assert tmpdir.join('simple', 'index.json').check(file=True)
+    assert tmpdir.join('simple', 'ocflib', 'index.json').check(file=True)
+
+
+def test_build_repo_simple_and_project_pages(tmp_path):
+    files = {
+        main.Package.create(
+            filename='pkg-1.0.tar.gz',
+            hash='sha256=deadbeef',
+            requires_python='>=3',
+            upload_timestamp=1528586805,
+            uploaded_by='ckuehl',
+            yanked_reason='broken',
+        ),
+        main.Package.create(filename='pkg-2.0.tar.gz'),
+    }
+    main.build_repo({'pkg': files}, None, SETTINGS._replace(output_dir=str(tmp_path)))
+
+    # The simple page only has what installers need.
+    assert (tmp_path / 'simple' / 'pkg' / 'index.html').read_text() == (
+        '<!doctype html>\n'
+        '<html><head><title>Links for pkg</title></head><body>\n'
+        '<h1>Links for pkg</h1>\n'
+        '<a href="../../pool/pkg-2.0.tar.gz">pkg-2.0.tar.gz</a><br>\n'
+        '<a href="../../pool/pkg-1.0.tar.gz#sha256=deadbeef" data-requires-python="&gt;=3" data-yanked="broken">'
+        'pkg-1.0.tar.gz</a><br>\n'
+        '</body></html>'
+    )
+
+    project = (tmp_path / 'project' / 'pkg' / 'index.html').read_text()
+    assert 'value="pkg==2.0"' in project
+    assert '2018-06-09 23:26:45' in project
+    assert 'ckuehl' in project
+    assert '(yanked: broken)' in project
+    assert 'href="../../simple/pkg/index.html"' in project
 
 
 def _write_json_package_list(path, packages):
@@ -417,6 +550,8 @@ def test_build_repo_partial_rebuild(tmp_path):
     # timestamp changed on c 0.0.2.
     assert (tmp_path / 'simple' / 'c' / 'index.html').is_file()
     assert (tmp_path / 'pypi' / 'c' / 'json').is_file()
+    assert (tmp_path / 'pypi' / 'c' / '0.0.2' / 'json').is_file()
+    assert not (tmp_path / 'pypi' / 'c' / '0.0.1').is_dir()
 
     # d is new.
     assert (tmp_path / 'simple' / 'd' / 'index.html').is_file()
@@ -447,6 +582,61 @@ def test_build_repo_partial_rebuild(tmp_path):
     assert found == expected
 
 
+def test_build_repo_partial_rebuild_of_older_output(tmp_path):
+    previous_packages = tmp_path / 'previous-packages'
+    previous_packages.write_text('a-0.0.1.tar.gz\n')
+    packages = tmp_path / 'packages'
+    packages.write_text('a-0.0.1.tar.gz\nb-0.0.1.tar.gz\n')
+    output_dir = tmp_path / 'output'
+    argv = ('--output-dir', str(output_dir), '--packages-url', '../../pool/')
+    main.main(('--package-list', str(previous_packages), *argv))
+
+    # Pretend the output was built by an older version, which numbered the
+    # changelog differently and didn't save any state.
+    (output_dir / main.STATE_DIR / 'state.json').unlink()
+    (output_dir / 'changelog' / 'page1.html').write_text('old numbering')
+    main.main(('--previous-package-list', str(previous_packages), '--package-list', str(packages), *argv))
+    assert 'old numbering' not in (output_dir / 'changelog' / 'page1.html').read_text()
+    assert (output_dir / main.STATE_DIR / 'state.json').exists()
+
+    # Once the state is saved, partial builds only write what changed.
+    more_packages = tmp_path / 'more-packages'
+    more_packages.write_text('a-0.0.1.tar.gz\nb-0.0.1.tar.gz\nc-0.0.1.tar.gz\n')
+    (output_dir / 'simple' / 'a' / 'index.html').unlink()
+    main.main(('--previous-package-list', str(packages), '--package-list', str(more_packages), *argv))
+    assert not (output_dir / 'simple' / 'a' / 'index.html').exists()
+    assert (output_dir / 'simple' / 'c' / 'index.html').exists()
+
+
+def _build_older_output(tmp_path, remove_glob):
+    """Build a site, then make it look like an older version's output."""
+    previous_packages = tmp_path / 'previous-packages'
+    previous_packages.write_text('a-0.0.1.tar.gz\n')
+    output_dir = tmp_path / 'output'
+    argv = ('--output-dir', str(output_dir), '--packages-url', '../../pool/')
+    main.main(('--package-list', str(previous_packages), *argv))
+    (output_dir / main.STATE_DIR / 'state.json').unlink()
+    for path in output_dir.glob(remove_glob):
+        path.unlink()
+    packages = tmp_path / 'packages'
+    packages.write_text('a-0.0.1.tar.gz\nb-0.0.1.tar.gz\n')
+    return ('--previous-package-list', str(previous_packages), '--package-list', str(packages), *argv)
+
+
+def test_build_repo_partial_rebuild_adds_simple_json(tmp_path):
+    main.main(_build_older_output(tmp_path, 'simple/**/index.json'))
+    output_dir = tmp_path / 'output'
+    assert (output_dir / 'simple' / 'index.json').is_file()
+    assert (output_dir / 'simple' / 'a' / 'index.json').is_file()
+
+
+def test_build_repo_partial_rebuild_adds_project_pages(tmp_path):
+    main.main(_build_older_output(tmp_path, 'project/*/index.html'))
+    output_dir = tmp_path / 'output'
+    assert 'project/a/index.html' in (output_dir / 'index.html').read_text()
+    assert (output_dir / 'project' / 'a' / 'index.html').is_file()
+
+
 def test_build_repo_partial_rebuild_new_version_only(tmp_path):
     package_list = (
         {"filename": "a-0.0.1.tar.gz"},
@@ -474,12 +664,41 @@ def test_build_repo_partial_rebuild_new_version_only(tmp_path):
 
     assert (tmp_path / 'simple' / 'b' / 'index.html').is_file()
     assert (tmp_path / 'pypi' / 'b' / 'json').is_file()
-    assert (tmp_path / 'pypi' / 'b' / '0.0.1' / 'json').is_file()
+    # Only the new version's JSON is written.
+    assert not (tmp_path / 'pypi' / 'b' / '0.0.1' / 'json').is_file()
+    assert (tmp_path / 'pypi' / 'b' / '0.0.2' / 'json').is_file()
 
     assert (tmp_path / 'index.html').is_file()
     assert (tmp_path / 'changelog').is_dir()
 
 
+def test_build_repo_partial_rebuild_removed_version(tmp_path):
+    previous_packages = tmp_path / 'previous-packages'
+    packages = tmp_path / 'packages'
+    _write_json_package_list(previous_packages, (
+        {"filename": "a-0.0.1.tar.gz"},
+        {"filename": "a-0.0.2.tar.gz"},
+    ))
+    _write_json_package_list(packages, (
+        {"filename": "a-0.0.1.tar.gz"},
+    ))
+    main.main((
+        '--package-list-json', str(previous_packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    assert (tmp_path / 'pypi' / 'a' / '0.0.2' / 'json').is_file()
+
+    main.main((
+        '--previous-package-list-json', str(previous_packages),
+        '--package-list-json', str(packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    assert (tmp_path / 'pypi' / 'a' / '0.0.1' / 'json').is_file()
+    assert not (tmp_path / 'pypi' / 'a' / '0.0.2').exists()
+
+
 def test_build_repo_partial_rebuild_no_changes_at_all(tmp_path):
     package_list = (
         {"filename": "a-0.0.1.tar.gz"},
@@ -504,6 +723,546 @@ def test_build_repo_partial_rebuild_no_changes_at_all(tmp_path):
     assert not (tmp_path / 'pypi').is_dir()
 
 
+def test_build_repo_partial_rebuild_simple_json(tmp_path):
+    previous = {'a': {main.Package.create(filename='a-1.0.tar.gz')}}
+    packages = {
+        'a': {main.Package.create(filename='a-1.0.tar.gz')},
+        'b': {main.Package.create(filename='b-1.0.tar.gz', size=10)},
+    }
+    settings = SETTINGS._replace(output_dir=str(tmp_path))
+    main.build_repo(previous, None, settings)
+    os.utime(tmp_path / 'simple' / 'a' / 'index.json', (1, 1))
+    main.build_repo(packages, previous, settings)
+
+    assert (tmp_path / 'simple' / 'a' / 'index.json').stat().st_mtime == 1
+    assert json.loads((tmp_path / 'simple' / 'b' / 'index.json').read_text()) == {
+        'meta': {'api-version': '1.1'},
+        'name': 'b',
+        'versions': ['1.0'],
+        'files': [{
+            'filename': 'b-1.0.tar.gz',
+            'url': '../../pool/b-1.0.tar.gz',
+            'hashes': {},
+            'yanked': False,
+            'size': 10,
+        }],
+    }
+    assert json.loads((tmp_path / 'simple' / 'index.json').read_text())['projects'] == [
+        {'name': 'a'},
+        {'name': 'b'},
+    ]
+
+
+def test_build_repo_search_index(tmp_path):
+    packages = {
+        name: {main.Package.create(filename=f'{name}-1.0.tar.gz'), main.Package.create(filename=f'{name}-2.0.tar.gz')}
+        for name in ('abc', 'abd', 'b', 'xyz')
+    }
+    settings = SETTINGS._replace(output_dir=str(tmp_path), search_index=True)
+    main.build_repo(packages, None, settings)
+
+    assert sorted(os.listdir(tmp_path / 'search')) == ['ab.json', 'b.json', 'index.json', 'xy.json']
+    assert json.loads((tmp_path / 'search' / 'index.json').read_text()) == {
+        'total': 4,
+        'shards': {'ab': 2, 'b': 1, 'xy': 1},
+    }
+    assert json.loads((tmp_path / 'search' / 'ab.json').read_text()) == [['abc', '2.0'], ['abd', '2.0']]
+    # The root page doesn't list the packages itself.
+    assert 'project/abc/index.html' not in (tmp_path / 'index.html').read_text()
+
+    # Only the shards with changed packages are rewritten.
+    for shard in ('ab', 'b'):
+        os.utime(tmp_path / 'search' / f'{shard}.json', (1, 1))
+    new_packages = dict(packages, b={main.Package.create(filename='b-3.0.tar.gz')})
+    del new_packages['xyz']
+    main.build_repo(new_packages, packages, settings)
+    assert (tmp_path / 'search' / 'ab.json').stat().st_mtime == 1
+    assert json.loads((tmp_path / 'search' / 'b.json').read_text()) == [['b', '3.0']]
+    assert not (tmp_path / 'search' / 'xy.json').exists()
+    assert json.loads((tmp_path / 'search' / 'index.json').read_text())['shards'] == {'ab': 2, 'b': 1}
+
+    # The index of the shards is only rewritten when packages are added or removed.
+    os.utime(tmp_path / 'search' / 'index.json', (1, 1))
+    main.build_repo(dict(new_packages, b={main.Package.create(filename='b-4.0.tar.gz')}), new_packages, settings)
+    assert (tmp_path / 'search' / 'index.json').stat().st_mtime == 1
+    assert json.loads((tmp_path / 'search' / 'b.json').read_text()) == [['b', '4.0']]
+
+
+def test_build_repo_search_index_turned_off(tmp_path):
+    packages = {'abc': {main.Package.create(filename='abc-1.0.tar.gz')}}
+    settings = SETTINGS._replace(output_dir=str(tmp_path), search_index=True)
+    state = main.build_repo(packages, None, settings, prune=True)
+    assert (tmp_path / 'search' / 'ab.json').exists()
+
+    settings = settings._replace(search_index=False)
+    state = main.build_repo(packages, None, settings, previous_state=state)
+    assert (tmp_path / 'search' / 'ab.json').exists()
+    main.build_repo(packages, None, settings, previous_state=state, prune=True)
+    assert not (tmp_path / 'search').exists()
+
+
+def test_build_repo_without_search_index_lists_packages(tmp_path):
+    packages = {'abc': {main.Package.create(filename='abc-1.0.tar.gz')}}
+    main.build_repo(packages, None, SETTINGS._replace(output_dir=str(tmp_path)))
+    assert not (tmp_path / 'search').exists()
+    assert 'href="project/abc/index.html"' in (tmp_path / 'index.html').read_text()
+
+
+def test_changelog_files():
+    a1 = main.Package.create(filename='a-1.0.tar.gz', upload_timestamp=2)
+    a2 = main.Package.create(filename='a-2.0.tar.gz', upload_timestamp=2)
+    b1 = main.Package.create(filename='b-1.0.tar.gz', upload_timestamp=1)
+    c1 = main.Package.create(filename='c-1.0.tar.gz')
+    # Files uploaded at the same time are in reverse sort_key order.
+    assert main._changelog_files({'b': [b1], 'a': [a1, a2], 'c': [c1]}) == [c1, b1, a2, a1]
+
+
+def _changelog_links(path):
+    return re.findall('<a href="([^"]+)"', path.read_text())
+
+
+def test_build_repo_changelog_pages_are_stable(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'CHANGELOG_ENTRIES_PER_PAGE', 2)
+    previous_packages = tmp_path / 'previous-packages'
+    packages = tmp_path / 'packages'
+    package_list = (
+        {"filename": "a-0.0.1.tar.gz", "upload_timestamp": 1},
+        {"filename": "a-0.0.2.tar.gz", "upload_timestamp": 2},
+        {"filename": "a-0.0.3.tar.gz", "upload_timestamp": 3},
+    )
+    _write_json_package_list(previous_packages, package_list)
+    _write_json_package_list(
+        packages,
+        package_list + ({"filename": "a-0.0.4.tar.gz", "upload_timestamp": 4},),
+    )
+    main.main((
+        '--package-list-json', str(previous_packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    changelog = tmp_path / 'changelog'
+    assert _changelog_links(changelog / 'page1.html') == [
+        'latest.html', 'page2.html',
+        '../../pool/a-0.0.2.tar.gz',
+        '../../pool/a-0.0.1.tar.gz',
+        'latest.html', 'page2.html',
+    ]
+    assert _changelog_links(changelog / 'page2.html') == [
+        'page1.html', 'page1.html',
+        '../../pool/a-0.0.3.tar.gz',
+        'page1.html', 'page1.html',
+    ]
+    assert (changelog / 'latest.html').read_text() == (changelog / 'page2.html').read_text()
+
+    (changelog / 'page1.html').unlink()
+    main.main((
+        '--previous-package-list-json', str(previous_packages),
+        '--package-list-json', str(packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    # The oldest page is unaffected by the new upload.
+    assert not (changelog / 'page1.html').exists()
+    assert _changelog_links(changelog / 'page2.html') == [
+        'page1.html', 'page1.html',
+        '../../pool/a-0.0.4.tar.gz',
+        '../../pool/a-0.0.3.tar.gz',
+        'page1.html', 'page1.html',
+    ]
+    assert (changelog / 'latest.html').read_text() == (changelog / 'page2.html').read_text()
+
+
+def test_build_repo_changelog_removes_pages(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'CHANGELOG_ENTRIES_PER_PAGE', 1)
+    previous_packages = tmp_path / 'previous-packages'
+    packages = tmp_path / 'packages'
+    _write_json_package_list(previous_packages, (
+        {"filename": "a-0.0.1.tar.gz", "upload_timestamp": 1},
+        {"filename": "a-0.0.2.tar.gz", "upload_timestamp": 2},
+        {"filename": "a-0.0.3.tar.gz", "upload_timestamp": 3},
+    ))
+    _write_json_package_list(packages, (
+        {"filename": "a-0.0.1.tar.gz", "upload_timestamp": 1},
+        {"filename": "a-0.0.2.tar.gz", "upload_timestamp": 2},
+    ))
+    main.main((
+        '--package-list-json', str(previous_packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    main.main((
+        '--previous-package-list-json', str(previous_packages),
+        '--package-list-json', str(packages),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool/',
+    ))
+    changelog = tmp_path / 'changelog'
+    assert sorted(os.listdir(changelog)) == ['latest.html', 'page1.html', 'page2.html']
+    # page2 is the newest page again, so it has no links to newer pages.
+    assert _changelog_links(changelog / 'page2.html') == [
+        'page1.html', 'page1.html',
+        '../../pool/a-0.0.2.tar.gz',
+        'page1.html', 'page1.html',
+    ]
+
+
+def test_build_repo_incremental(tmp_path):
+    packages = tmp_path / 'packages'
+    output_dir = tmp_path / 'output'
+    argv = (
+        '--package-list-json', str(packages),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--incremental',
+    )
+    _write_json_package_list(packages, (
+        {"filename": "a-0.0.1.tar.gz"},
+        {"filename": "b-0.0.1.tar.gz"},
+    ))
+    # Without any saved state, everything is built.
+    main.main(argv)
+    assert (output_dir / 'simple' / 'a' / 'index.html').is_file()
+    assert (output_dir / 'simple' / 'b' / 'index.html').is_file()
+    assert (output_dir / main.STATE_DIR / 'state.json').is_file()
+
+    # Nothing changed, so nothing is written.
+    (output_dir / 'index.html').unlink()
+    main.main(argv)
+    assert not (output_dir / 'index.html').exists()
+
+    _write_json_package_list(packages, (
+        {"filename": "a-0.0.1.tar.gz"},
+        {"filename": "b-0.0.1.tar.gz"},
+        {"filename": "b-0.0.2.tar.gz"},
+    ))
+    (output_dir / 'simple' / 'a' / 'index.html').unlink()
+    (output_dir / 'pypi' / 'b' / '0.0.1' / 'json').unlink()
+    main.main(argv)
+    assert not (output_dir / 'simple' / 'a' / 'index.html').exists()
+    assert not (output_dir / 'pypi' / 'b' / '0.0.1' / 'json').exists()
+    assert (output_dir / 'pypi' / 'b' / '0.0.2' / 'json').is_file()
+    assert (output_dir / 'index.html').is_file()
+
+
+def test_build_repo_incremental_settings_changed(tmp_path):
+    packages = tmp_path / 'packages'
+    packages.write_text('a-0.0.1.tar.gz\n')
+    output_dir = tmp_path / 'output'
+    argv = [
+        '--package-list', str(packages),
+        '--output-dir', str(output_dir),
+        '--incremental',
+    ]
+    main.main(argv + ['--packages-url', 'http://a/'])
+    main.main(argv + ['--packages-url', 'http://changed/', '--title', 'New Title'])
+    assert 'http://changed/a-0.0.1.tar.gz' in (output_dir / 'simple' / 'a' / 'index.html').read_text()
+    assert 'New Title' in (output_dir / 'index.html').read_text()
+
+
+def test_build_repo_incremental_switch_to_generations(tmp_path):
+    packages = tmp_path / 'packages'
+    packages.write_text('a-0.0.1.tar.gz\n')
+    output_dir = tmp_path / 'output'
+    argv = (
+        '--package-list', str(packages),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--incremental',
+    )
+    main.main(argv)
+    # The input is the same, but the output goes somewhere else now.
+    main.main((*argv, '--generations'))
+    assert (output_dir / main.CURRENT_GENERATION / 'simple' / 'a' / 'index.html').is_file()
+
+    # Going back to the plain directory rebuilds it too.
+    (output_dir / 'simple' / 'a' / 'index.html').unlink()
+    main.main(argv)
+    assert (output_dir / 'simple' / 'a' / 'index.html').is_file()
+
+
+def test_build_repo_incremental_switch_archive_and_directory(tmp_path):
+    packages = tmp_path / 'packages'
+    packages.write_text('a-0.0.1.tar.gz\n')
+    output_dir = tmp_path / 'output'
+    argv = (
+        '--package-list', str(packages),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--incremental',
+    )
+    main.main((*argv, '--archive', str(tmp_path / 'a.tar')))
+    main.main(argv)
+    assert (output_dir / 'simple' / 'a' / 'index.html').is_file()
+
+    # The archive gets everything again, not an empty "nothing changed" one.
+    main.main((*argv, '--archive', str(tmp_path / 'a.tar')))
+    assert 'simple/a/index.html' in _read_tar(tmp_path / 'a.tar')
+    main.main((*argv, '--archive', str(tmp_path / 'a.tar')))
+    assert _read_tar(tmp_path / 'a.tar') == {}
+
+
+def test_build_repo_full_build_replaces_saved_state(tmp_path):
+    output_dir = tmp_path / 'output'
+    l1 = tmp_path / 'l1'
+    l1.write_text('foo-1.0.tar.gz\n')
+    l2 = tmp_path / 'l2'
+    l2.write_text('foo-1.0.tar.gz\nbaz-1.0.tar.gz\n')
+    argv = ('--output-dir', str(output_dir), '--packages-url', '../../pool/')
+    main.main(('--package-list', str(l1), '--incremental', *argv))
+    main.main(('--package-list', str(l2), *argv))
+    assert not (output_dir / main.STATE_DIR / 'fingerprint').exists()
+    # The saved state is the plain build's, so baz is noticed as removed.
+    main.main(('--package-list', str(l1), '--incremental', *argv))
+    assert 'baz' not in (output_dir / 'simple' / 'index.html').read_text()
+
+
+def test_build_repo_incremental_unchanged_input_fast_path(tmp_path):
+    packages = tmp_path / 'packages'
+    packages.write_text('a-0.0.1.tar.gz\n')
+    output_dir = tmp_path / 'output'
+    argv = [
+        '--package-list', str(packages),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--incremental',
+    ]
+    main.main(argv)
+    assert (output_dir / main.STATE_DIR / 'fingerprint').is_file()
+
+    # Stops before parsing anything or importing jinja2.
+    script = (
+        'import sys\n'
+        'from dumb_pypi import main\n'
+        'main.Package.create = None\n'
+        f'assert main.main({argv!r}) == 0\n'
+        'assert "jinja2" not in sys.modules\n'
+    )
+    subprocess.check_call((sys.executable, '-c', script))
+
+    # Settings are part of the fingerprint.
+    fingerprint = (output_dir / main.STATE_DIR / 'fingerprint').read_text()
+    main.main(argv + ['--title', 'Another Title'])
+    assert (output_dir / main.STATE_DIR / 'fingerprint').read_text() != fingerprint
+
+
+def test_package_index_remove():
+    a1, a2 = (main.Package.create(filename=f'a-{v}.tar.gz') for v in ('1.0', '2.0'))
+    index = main.PackageIndex.from_packages({'a': {a1}})
+    index.add(a2)
+    index.remove(a2)
+    # Removing one file of a release keeps the release.
+    wheel = main.Package.create(filename='a-1.0-py3-none-any.whl')
+    index.add(wheel)
+    index.remove(wheel)
+    assert index == {'a': {a1}}
+    expected = main.PackageIndex.from_packages({'a': {a1}})
+    assert index.package_digests == expected.package_digests
+    assert index.release_digests == expected.release_digests
+    index.remove(a1)
+    assert index == {}
+    assert index.package_digests == index.release_digests == {}
+
+
+def test_apply_delta(tmp_path, capsys):
+    packages = main.PackageIndex.from_packages({
+        'a': {main.Package.create(filename='a-1.0.tar.gz')},
+        'b': {main.Package.create(filename='b-1.0.tar.gz', upload_timestamp=1)},
+        'c': {main.Package.create(filename='c-1.0.tar.gz')},
+    })
+    delta = tmp_path / 'delta'
+    _write_json_package_list(delta, (
+        {'action': 'add', 'filename': 'a-2.0.tar.gz', 'upload_timestamp': 2},
+        {'action': 'update', 'filename': 'b-1.0.tar.gz', 'upload_timestamp': 3},
+        {'action': 'remove', 'filename': 'c-1.0.tar.gz'},
+        {'action': 'yank', 'filename': 'a-1.0.tar.gz', 'yanked_reason': 'broken'},
+        {'action': 'yank', 'filename': 'a-2.0.tar.gz'},
+        {'action': 'remove', 'filename': 'd-1.0.tar.gz'},
+        {'action': 'update', 'filename': 'd-1.0.tar.gz'},
+        {'action': 'frobnicate', 'filename': 'a-1.0.tar.gz'},
+        {'action': 'add', 'filename': 'a-3.0.tar.gz', 'sha': '1'},
+        [1],
+        {'action': 'add', 'filename': 'a-3.0.tar.gz', 'upload_timestamp': 'abc'},
+        {'action': 'add', 'filename': 'a-3.0.tar.gz', 'requires_dist': [1]},
+        {'action': 'add', 'filename': 1},
+    ))
+    new_packages = main.apply_delta(packages, str(delta))
+
+    assert new_packages == {
+        'a': {
+            main.Package.create(filename='a-1.0.tar.gz', yanked_reason='broken'),
+            main.Package.create(filename='a-2.0.tar.gz', upload_timestamp=2),
+        },
+        'b': {main.Package.create(filename='b-1.0.tar.gz', upload_timestamp=3)},
+    }
+    assert new_packages.package_digests == main.PackageIndex.from_packages(new_packages).package_digests
+    # The original is left alone.
+    assert set(packages) == {'a', 'b', 'c'}
+    assert capsys.readouterr().err.splitlines() == [
+        'Yank event without a yanked_reason: a-2.0.tar.gz (skipping event)',
+        'Cannot remove unknown file: d-1.0.tar.gz (skipping event)',
+        'Cannot update unknown file: d-1.0.tar.gz (skipping event)',
+        "Unknown delta action 'frobnicate' for a-1.0.tar.gz (skipping event)",
+        "Unknown key 'sha' in delta event for a-3.0.tar.gz (skipping event)",
+        'Delta event is not a JSON object: [1] (skipping event)',
+        "Invalid upload_timestamp in delta event for a-3.0.tar.gz: 'abc' (skipping event)",
+        'Invalid requires_dist in delta event for a-3.0.tar.gz: [1] (skipping event)',
+        "Delta event without a filename: {'filename': 1} (skipping event)",
+    ]
+
+
+def test_build_repo_apply_delta(tmp_path):
+    packages = tmp_path / 'packages'
+    output_dir = tmp_path / 'output'
+    _write_json_package_list(packages, (
+        {"filename": "a-0.0.1.tar.gz"},
+        {"filename": "b-0.0.1.tar.gz"},
+    ))
+    main.main((
+        '--package-list-json', str(packages),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+    ))
+    (output_dir / 'simple' / 'a' / 'index.html').unlink()
+
+    delta = tmp_path / 'delta'
+    _write_json_package_list(delta, (
+        {'action': 'add', 'filename': 'b-0.0.2.tar.gz'},
+    ))
+    main.main((
+        '--apply-delta', str(delta),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+    ))
+    assert not (output_dir / 'simple' / 'a' / 'index.html').exists()
+    assert 'b-0.0.2.tar.gz' in (output_dir / 'simple' / 'b' / 'index.html').read_text()
+    assert [
+        json.loads(line)['filename']
+        for line in (output_dir / 'packages.json').read_text().splitlines()
+    ] == ['a-0.0.1.tar.gz', 'b-0.0.1.tar.gz', 'b-0.0.2.tar.gz']
+
+
+def test_build_repo_apply_delta_with_previous_package_list(tmp_path):
+    packages = tmp_path / 'packages'
+    output_dir = tmp_path / 'output'
+    _write_json_package_list(packages, (
+        {"filename": "a-0.0.1.tar.gz"},
+        {"filename": "b-0.0.1.tar.gz"},
+    ))
+    main.main((
+        '--package-list-json', str(packages),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+    ))
+    (output_dir / 'simple' / 'a' / 'index.html').unlink()
+    (output_dir / 'simple' / 'b' / 'index.html').unlink()
+
+    # The given previous package list is used instead of packages.json.
+    previous = tmp_path / 'previous'
+    _write_json_package_list(previous, ({"filename": "b-0.0.1.tar.gz"},))
+    delta = tmp_path / 'delta'
+    _write_json_package_list(delta, ())
+    main.main((
+        '--apply-delta', str(delta),
+        '--previous-package-list-json', str(previous),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+    ))
+    assert (output_dir / 'simple' / 'a' / 'index.html').exists()
+    assert not (output_dir / 'simple' / 'b' / 'index.html').exists()
+
+
+def test_build_repo_apply_delta_without_previous_build(tmp_path):
+    delta = tmp_path / 'delta'
+    delta.write_text('')
+    with pytest.raises(SystemExit):
+        main.main((
+            '--apply-delta', str(delta),
+            '--output-dir', str(tmp_path / 'output'),
+            '--packages-url', '../../pool/',
+        ))
+
+
+def test_repo_state_round_trip(tmp_path):
+    package = main.Package.create(filename='a-1.0.tar.gz')
+    state = main.RepoState.create(
+        main.PackageIndex.from_packages({'a': {package}}),
+        [[package]],
+        SETTINGS,
+    )
+    path = str(tmp_path / 'state.json')
+    state.save(path)
+    assert main.RepoState.load(path) == state
+
+
+def test_repo_state_load_missing_or_old(tmp_path, monkeypatch):
+    path = str(tmp_path / 'state.json')
+    assert main.RepoState.load(path) is None
+    main.RepoState.create(main.PackageIndex(), [], SETTINGS).save(path)
+    monkeypatch.setattr(main, 'STATE_VERSION', main.STATE_VERSION + 1)
+    assert main.RepoState.load(path) is None
+
+
+@pytest.mark.parametrize('content', ('{"version": 3', '[]', json.dumps({'version': main.STATE_VERSION})))
+def test_repo_state_load_unreadable(tmp_path, capsys, content):
+    path = tmp_path / 'state.json'
+    path.write_text(content)
+    assert main.RepoState.load(str(path)) is None
+    assert capsys.readouterr().err.startswith('Ignoring unreadable build state')
+
+
+def test_build_repo_incremental_corrupt_state(tmp_path):
+    packages = tmp_path / 'packages'
+    packages.write_text('a-0.0.1.tar.gz\n')
+    output_dir = tmp_path / 'output'
+    (output_dir / main.STATE_DIR).mkdir(parents=True)
+    (output_dir / main.STATE_DIR / 'state.json').write_text('garbage')
+    main.main((
+        '--package-list', str(packages),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool/',
+        '--incremental',
+    ))
+    assert (output_dir / 'simple' / 'a' / 'index.html').is_file()
+    assert main.RepoState.load(str(output_dir / main.STATE_DIR / 'state.json')) is not None
+
+
+def test_package_index_digests():
+    a1, a2 = (main.Package.create(filename=f'a-{v}.tar.gz') for v in ('1.0', '2.0'))
+    b1 = main.Package.create(filename='b-1.0.tar.gz')
+
+    index = main.PackageIndex()
+    for package in (a1, a2, b1):
+        index.add(package)
+    other_index = main.PackageIndex()
+    # Order doesn't matter, and adding the same file twice changes nothing.
+    for package in (b1, a2, a1, a2):
+        other_index.add(package)
+
+    assert index == other_index == {'a': {a1, a2}, 'b': {b1}}
+    assert index.package_digests == other_index.package_digests
+    assert index.release_digests == other_index.release_digests
+    assert index.digest == other_index.digest
+    assert index.release_digests['a']['1.0'] != index.release_digests['a']['2.0']
+
+    changed = main.PackageIndex.from_packages({
+        'a': {a1, a2._replace(upload_timestamp=1)},
+        'b': {b1},
+    })
+    assert changed.package_digests['a'] != index.package_digests['a']
+    assert changed.package_digests['b'] == index.package_digests['b']
+    assert changed.release_digests['a']['1.0'] == index.release_digests['a']['1.0']
+    assert changed.digest != index.digest
+
+
+def test_create_packages_digests_with_jobs(monkeypatch):
+    monkeypatch.setattr(main, 'PARSE_CHUNK_SIZE', 1)
+    infos: list[dict[str, Any]] = [{'filename': 'a-1.0.tar.gz'}, {'filename': 'a-2.0.tar.gz', 'upload_timestamp': 5}]
+    serial = main._create_packages(iter(infos))
+    parallel = main._create_packages(iter(infos), jobs=2)
+    assert parallel.package_digests == serial.package_digests
+    assert parallel.release_digests == serial.release_digests
+
+
 def test_build_repo_no_generate_timestamp(tmpdir):
     package_list = tmpdir.join('package-list')
     package_list.write('pkg-1.0.tar.gz\n')
@@ -513,7 +1272,7 @@ def test_build_repo_no_generate_timestamp(tmpdir):
         '--packages-url', '../../pool',
         '--no-generate-timestamp',
     ))
-    for p in ('simple/index.html', 'simple/pkg/index.html'):
+    for p in ('simple/index.html', 'project/pkg/index.html'):
         assert 'Generated on' not in tmpdir.join(p).read()
 
 
@@ -550,6 +1309,282 @@ def test_build_repo_even_with_bad_package_names(tmpdir):
     assert tmpdir.join('simple', 'ocflib', 'index.html').check(file=True)
 
 
+def test_lines_from_path(tmp_path):
+    path = tmp_path / 'package-list'
+    path.write_bytes(b'a-1.tar.gz\r\nb-1.tar.gz\n\nc-1.tar.gz')
+    assert list(main._lines_from_path(str(path))) == [
+        'a-1.tar.gz', 'b-1.tar.gz', '', 'c-1.tar.gz',
+    ]
+
+
+def test_lines_from_path_stdin_is_streamed(monkeypatch):
+    stdin = io.StringIO('a-1.tar.gz\nb-1.tar.gz\n')
+    monkeypatch.setattr(sys, 'stdin', stdin)
+    lines = main._lines_from_path('-')
+    assert next(lines) == 'a-1.tar.gz'
+    # Only the first line has been consumed so far.
+    assert stdin.read() == 'b-1.tar.gz\n'
+
+
+def test_create_packages_chunk():
+    packages, errors = main._create_packages_chunk(([{'filename': 'a-1.0.tar.gz'}, {'filename': '..'}], None))
+    package = main.Package.create(filename='a-1.0.tar.gz')
+    assert packages == [(package, main._digest_package(package))]
+    assert errors == ['Unsafe package name: .. (skipping package)']
+
+
+def test_create_packages_parallel_matches_serial(monkeypatch, capsys):
+    monkeypatch.setattr(main, 'PARSE_CHUNK_SIZE', 2)
+    infos: list[dict[str, Any]] = [
+        {'filename': 'a-1.0.tar.gz'},
+        {'filename': '..'},
+        {'filename': 'b-1.0.tar.gz', 'upload_timestamp': 1},
+        {'filename': 'a-2.0-py3-none-any.whl'},
+        {'filename': 'lol.whl'},
+        {'filename': 'a-1.0.tar.gz'},
+        {'filename': '/blah-2.tar.gz'},
+    ]
+
+    serial = main._create_packages(iter(infos))
+    serial_err = capsys.readouterr().err
+    parallel = main._create_packages(iter(infos), jobs=2)
+    parallel_err = capsys.readouterr().err
+
+    assert parallel == serial
+    assert set(parallel) == {'a', 'b'}
+    assert parallel_err == serial_err
+    assert parallel_err.splitlines() == [
+        'Unsafe package name: .. (skipping package)',
+        'Invalid package name: lol.whl (skipping package)',
+        'Unsafe package name: /blah-2.tar.gz (skipping package)',
+    ]
+
+
+def test_build_repo_jobs(tmp_path):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('pkg-1.0.tar.gz\npkg-2.0.tar.gz\n')
+    main.main((
+        '--package-list', str(package_list),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool',
+        '--jobs', '2',
+    ))
+    assert (tmp_path / 'pypi' / 'pkg' / '2.0' / 'json').is_file()
+
+
+def _read_tree(path):
+    """The generated files under path, leaving out the saved build state."""
+    return {
+        os.path.relpath(os.path.join(dirpath, filename), path): open(os.path.join(dirpath, filename), 'rb').read()
+        for dirpath, _, filenames in os.walk(path)
+        if os.path.relpath(dirpath, path).split(os.sep)[0] != main.STATE_DIR
+        for filename in filenames
+    }
+
+
+def test_build_repo_rendering_with_jobs_matches_serial(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'RENDER_CHUNK_SIZE', 1)
+    packages = main.PackageIndex.from_packages({
+        name: {
+            main.Package.create(filename=f'{name}-{version}.tar.gz', upload_timestamp=i)
+            for i, version in enumerate(('1.0', '1.1', '2.0'))
+        }
+        for name in ('a', 'b', 'c', 'd')
+    })
+    settings = SETTINGS._replace(output_dir=str(tmp_path), generate_timestamp=False)
+    serial = tmp_path / 'serial'
+    parallel = tmp_path / 'parallel'
+    main.build_repo(packages, None, settings, main.OutputDirectory(str(serial)))
+    main.build_repo(packages, None, settings, main.OutputDirectory(str(parallel)), jobs=2)
+    assert _read_tree(parallel) == _read_tree(serial)
+    assert 'pypi/d/2.0/json' in _read_tree(parallel)
+
+
+@pytest.mark.parametrize('generate_timestamp', (True, False))
+@pytest.mark.parametrize('package_names', ([], ['a'], ['a', 'b-c', 'd<&>"\'e']))
+def test_fast_render_simple_index_matches_jinja(generate_timestamp, package_names, monkeypatch):
+    monkeypatch.setattr(main, 'STREAM_BUFFER_SIZE', 2)
+    expected = main._jinja_env(SETTINGS).get_template('simple.html').render(
+        date='2024-01-02 03:04:05',
+        generate_timestamp=generate_timestamp,
+        package_names=package_names,
+    )
+    actual = ''.join(main._fast_render_simple_index(
+        package_names,
+        date='2024-01-02 03:04:05',
+        generate_timestamp=generate_timestamp,
+    ))
+    assert actual == expected
+
+
+@pytest.mark.parametrize('packages_url', ('../../pool/', 'https://ex&ample.com/"pool"'))
+@pytest.mark.parametrize('files', (
+    [],
+    [main.Package.create(filename='a-1.0.tar.gz')],
+    [
+        main.Package.create(filename='a-1.0.tar.gz'),
+        main.Package.create(filename='a-2.0-py3-none-any.whl', hash='sha256=deadbeef', upload_timestamp=1),
+    ],
+    [
+        main.Package.create(
+            filename='a-1.0.tar.gz',
+            hash='md5=<beef>',
+            requires_python='>=3.8, <4',
+            core_metadata='sha256=abc',
+            upload_timestamp=1517531041,
+            uploaded_by='"Ch&ris" <ckuehl>',
+            yanked_reason="it's <broken>",
+        ),
+        main.Package.create(filename='a-2.0.tar.gz', requires_python='>=3', core_metadata='true'),
+        main.Package.create(filename='a-3.0.tar.gz', yanked_reason='bad'),
+    ],
+    [main.Package.create(filename='a.tar.gz')],
+))
+def test_fast_render_package_matches_jinja(packages_url, files):
+    expected = main._jinja_env(SETTINGS).get_template('package.html').render(
+        package_name='a',
+        files=files,
+        packages_url=packages_url,
+    )
+    assert main._fast_render_package('a', files, packages_url=packages_url) == expected
+
+
+def test_build_repo_fast_simple_pages_matches_jinja(tmp_path):
+    package_list = tmp_path / 'package-list'
+    _write_json_package_list(package_list, [
+        {'filename': 'pkg-1.0.tar.gz', 'requires_python': '>=3', 'uploaded_by': '<me>', 'upload_timestamp': 1},
+        {'filename': 'pkg-2.0-py3-none-any.whl', 'hash': 'sha256=ab', 'yanked_reason': '"oops"'},
+        {'filename': 'other-0.1.tar.gz'},
+    ])
+    for output_dir, extra_args in (('jinja', ()), ('fast', ('--fast-simple-pages',))):
+        main.main((
+            '--package-list-json', str(package_list),
+            '--output-dir', str(tmp_path / output_dir),
+            '--packages-url', '../../pool',
+            '--no-generate-timestamp',
+            *extra_args,
+        ))
+    assert _read_tree(tmp_path / 'fast') == _read_tree(tmp_path / 'jinja')
+
+
+def test_build_repo_streams_large_pages(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'STREAM_BUFFER_SIZE', 2)
+    packages = {
+        name: {main.Package.create(filename=f'{name}-1.0.tar.gz')}
+        for name in ('a', 'b', 'c', 'd', 'e')
+    }
+    settings = SETTINGS._replace(output_dir=str(tmp_path), generate_timestamp=False)
+    written = {}
+
+    class RecordingOutput(main.OutputDirectory):
+        def write(self, path, content):
+            written[path] = content
+            super().write(path, content)
+
+    main.build_repo(packages, None, settings, RecordingOutput(str(tmp_path)))
+    jinja_env = main._jinja_env(settings)
+    assert not isinstance(written['index.html'], str)
+    assert (tmp_path / 'index.html').read_text() == jinja_env.get_template('index.html').render(
+        packages=[(name, '1.0') for name in sorted(packages)],
+    )
+    assert not isinstance(written['simple/index.html'], str)
+    assert (tmp_path / 'simple' / 'index.html').read_text() == jinja_env.get_template('simple.html').render(
+        generate_timestamp=False,
+        package_names=sorted(packages),
+    )
+
+
+def test_jobs_must_be_positive(tmp_path):
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', str(tmp_path / 'package-list'),
+            '--output-dir', str(tmp_path),
+            '--packages-url', '../../pool',
+            '--jobs', '0',
+        ))
+
+
+def test_parse_cache_round_trip(tmp_path):
+    path = str(tmp_path / 'cache')
+    cache = main.ParseCache()
+    filenames = ('f-1.0.tar.gz', 'f-1.0-py3-none-any.whl', 'F_g.tar.gz')
+    packages = [main.Package.create(filename=filename, parse_cache=cache) for filename in filenames]
+    cache.save(path)
+
+    loaded = main.ParseCache.load(path)
+    assert loaded.entries == {
+        'f-1.0.tar.gz': ('f', '1.0', packages[0].parsed_version),
+        'f-1.0-py3-none-any.whl': ('f', '1.0', packages[0].parsed_version),
+        'F_g.tar.gz': ('f-g', None, packages[2].parsed_version),
+    }
+    # Files of the same release share the parsed version.
+    assert loaded.entries['f-1.0.tar.gz'][2] is loaded.entries['f-1.0-py3-none-any.whl'][2]
+    assert [
+        main.Package.create(filename=filename, parse_cache=loaded) for filename in filenames
+    ] == packages
+
+
+def test_parse_cache_prunes_unused_entries(tmp_path):
+    path = str(tmp_path / 'cache')
+    cache = main.ParseCache()
+    cache.parse('a-1.0.tar.gz')
+    cache.parse('b-1.0.tar.gz')
+    cache.save(path)
+
+    cache = main.ParseCache.load(path)
+    cache.parse('b-1.0.tar.gz')
+    cache.save(path)
+    assert set(main.ParseCache.load(path).entries) == {'b-1.0.tar.gz'}
+
+
+def test_parse_cache_ignores_other_versions(tmp_path, monkeypatch):
+    path = str(tmp_path / 'cache')
+    cache = main.ParseCache()
+    cache.parse('a-1.0.tar.gz')
+    cache.save(path)
+    monkeypatch.setattr(main, 'PARSE_CACHE_VERSION', main.PARSE_CACHE_VERSION + 1)
+    assert main.ParseCache.load(path).entries == {}
+
+
+def test_parse_cache_ignores_corrupt_file(tmp_path, capsys):
+    path = tmp_path / 'cache'
+    path.write_bytes(b'garbage')
+    assert main.ParseCache.load(str(path)).entries == {}
+    assert 'Ignoring unreadable parse cache' in capsys.readouterr().err
+
+
+def test_parse_cache_with_jobs(monkeypatch):
+    monkeypatch.setattr(main, 'PARSE_CHUNK_SIZE', 1)
+    cache = main.ParseCache()
+    cache.parse('a-1.0.tar.gz')
+    cache = main.ParseCache(cache.used)
+    packages = main._create_packages(
+        iter(({'filename': 'a-1.0.tar.gz'}, {'filename': 'b-1.0.tar.gz'})),
+        jobs=2,
+        parse_cache=cache,
+    )
+    assert set(packages) == {'a', 'b'}
+    assert set(cache.used) == {'a-1.0.tar.gz', 'b-1.0.tar.gz'}
+
+
+def test_build_repo_parse_cache(tmp_path):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('pkg-1.0.tar.gz\n')
+    argv = (
+        '--package-list', str(package_list),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool',
+        '--parse-cache',
+    )
+    main.main(argv)
+    cache_path = tmp_path / main.STATE_DIR / 'parse-cache'
+    assert set(main.ParseCache.load(str(cache_path)).entries) == {'pkg-1.0.tar.gz'}
+
+    package_list.write_text('pkg-2.0.tar.gz\n')
+    main.main(argv)
+    assert set(main.ParseCache.load(str(cache_path)).entries) == {'pkg-2.0.tar.gz'}
+
+
 def test_atomic_write(tmpdir):
     a = tmpdir.join('a')
     a.write('sup')
@@ -569,6 +1604,726 @@ def test_atomic_write_exception(tmpdir):
     assert a.read() == 'sup'
 
 
+def test_output_directory_write(tmp_path):
+    output = main.OutputDirectory(str(tmp_path))
+    output.write('a/b/c.txt', 'hello')
+    output.write('streamed.txt', iter(('hel', 'lo')))
+    assert (tmp_path / 'a' / 'b' / 'c.txt').read_text() == 'hello'
+    assert (tmp_path / 'streamed.txt').read_text() == 'hello'
+    assert (output.written, output.skipped) == (2, 0)
+
+
+@pytest.mark.parametrize('content', ('same', iter(('sa', 'me'))))
+def test_output_directory_skip_unchanged(tmp_path, content):
+    path = tmp_path / 'f'
+    path.write_text('same')
+    os.utime(path, (1, 1))
+    output = main.OutputDirectory(str(tmp_path), skip_unchanged=True)
+    output.write('f', content)
+    assert (output.written, output.skipped) == (0, 1)
+    assert path.stat().st_mtime == 1
+    # The temporary file for streamed content was cleaned up.
+    assert os.listdir(tmp_path) == ['f']
+
+
+@pytest.mark.parametrize('content', ('different', iter(('diff', 'erent'))))
+def test_output_directory_skip_unchanged_changed(tmp_path, content):
+    path = tmp_path / 'f'
+    path.write_text('differenT')
+    output = main.OutputDirectory(str(tmp_path), skip_unchanged=True)
+    output.write('f', content)
+    assert (output.written, output.skipped) == (1, 0)
+    assert path.read_text() == 'different'
+
+
+def test_output_directory_skip_unchanged_changed_size(tmp_path):
+    path = tmp_path / 'f'
+    path.write_text('other size')
+    output = main.OutputDirectory(str(tmp_path), skip_unchanged=True)
+    output.write('f', 'different')
+    assert (output.written, output.skipped) == (1, 0)
+    assert path.read_text() == 'different'
+
+
+def test_output_directory_delete(tmp_path):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a' / 'f').write_text('')
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'b' / 'f').write_text('')
+    (tmp_path / 'b' / 'g').write_text('')
+    output = main.OutputDirectory(str(tmp_path))
+    output.delete('a/f')
+    output.delete('b/f')
+    output.delete('c/f')
+    assert not (tmp_path / 'a').exists()
+    assert os.listdir(tmp_path / 'b') == ['g']
+    assert output.deleted == 2
+
+
+@pytest.mark.parametrize('content', ('hello' * 100, iter(('hello',) * 100)))
+def test_output_directory_precompress(tmp_path, content):
+    brotli = pytest.importorskip('brotli')
+    output = main.OutputDirectory(str(tmp_path), precompress=('gzip', 'brotli'))
+    output.write('a/f.html', content)
+    assert gzip.decompress((tmp_path / 'a' / 'f.html.gz').read_bytes()) == b'hello' * 100
+    assert brotli.decompress((tmp_path / 'a' / 'f.html.br').read_bytes()) == b'hello' * 100
+    # The compressed files only depend on the content.
+    main.OutputDirectory(str(tmp_path), precompress=('gzip',)).write('g.html', 'hello' * 100)
+    assert (tmp_path / 'g.html.gz').read_bytes() == (tmp_path / 'a' / 'f.html.gz').read_bytes()
+
+    output.delete('a/f.html')
+    assert not (tmp_path / 'a').exists()
+
+
+def test_output_directory_precompress_unchanged(tmp_path):
+    output = main.OutputDirectory(str(tmp_path), skip_unchanged=True, precompress=('gzip',))
+    output.write('f', 'content')
+    first = (tmp_path / 'f.gz').read_bytes()
+    os.utime(tmp_path / 'f.gz', (1, 1))
+    output.write('f', iter(('con', 'tent')))
+    assert (tmp_path / 'f.gz').stat().st_mtime == 1
+
+    # Missing compressed files are added even if the content is unchanged.
+    (tmp_path / 'f.gz').unlink()
+    output.write('f', 'content')
+    assert (tmp_path / 'f.gz').read_bytes() == first
+    assert (output.written, output.skipped) == (1, 2)
+
+
+def test_build_repo_precompress(tmp_path):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('pkg-1.0.tar.gz\n')
+    main.main((
+        '--package-list', str(package_list),
+        '--output-dir', str(tmp_path / 'out'),
+        '--packages-url', '../../pool',
+        '--precompress', 'gzip',
+    ))
+    out = tmp_path / 'out'
+    for path in ('index.html', 'simple/index.html', 'simple/pkg/index.html', 'pypi/pkg/json'):
+        assert gzip.decompress((out / f'{path}.gz').read_bytes()) == (out / path).read_bytes()
+
+
+def test_precompress_unknown_format(tmp_path, capsys):
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', str(tmp_path / 'package-list'),
+            '--output-dir', str(tmp_path),
+            '--packages-url', '../../pool',
+            '--precompress', 'gzip,zip',
+        ))
+    assert 'unknown --precompress format: zip' in capsys.readouterr().err
+
+
+def test_precompress_brotli_missing(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(main.importlib.util, 'find_spec', lambda name: None)
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', str(tmp_path / 'package-list'),
+            '--output-dir', str(tmp_path),
+            '--packages-url', '../../pool',
+            '--precompress', 'gzip,brotli',
+        ))
+    assert '--precompress brotli needs the brotli package' in capsys.readouterr().err
+
+
+def test_build_repo_skip_unchanged(tmp_path, capsys):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('pkg-1.0.tar.gz\n')
+    argv = (
+        '--package-list', str(package_list),
+        '--output-dir', str(tmp_path),
+        '--packages-url', '../../pool',
+        '--no-generate-timestamp',
+        '--skip-unchanged',
+    )
+    main.main(argv)
+    assert capsys.readouterr().err == 'Wrote 11 files, skipped 0 unchanged files.\n'
+    main.main(argv)
+    assert capsys.readouterr().err == 'Wrote 0 files, skipped 11 unchanged files.\n'
+
+
+def test_output_directory_io_threads(tmp_path):
+    with main.OutputDirectory(str(tmp_path), io_threads=4, max_pending=2) as output:
+        for i in range(50):
+            output.write(f'd{i % 5}/f{i}', str(i))
+        output.write('streamed.txt', iter(('hel', 'lo')))
+        # Operations on the same path stay in order.
+        output.write('d0/f0', 'rewritten')
+        output.delete('d1/f1')
+        output.write('d1/f1', 'back')
+        output.delete('d2/f2')
+        output.flush()
+        assert (output.written, output.deleted) == (53, 2)
+    assert (tmp_path / 'd0' / 'f0').read_text() == 'rewritten'
+    assert (tmp_path / 'd1' / 'f1').read_text() == 'back'
+    assert not (tmp_path / 'd2' / 'f2').exists()
+    assert (tmp_path / 'd3' / 'f48').read_text() == '48'
+    assert (tmp_path / 'streamed.txt').read_text() == 'hello'
+
+
+def test_output_directory_io_threads_error(tmp_path):
+    (tmp_path / 'blocker').write_text('not a directory')
+    output = main.OutputDirectory(str(tmp_path), io_threads=2)
+    output.write('blocker/f', 'content')
+    with pytest.raises(OSError):
+        output.flush()
+    # The error is only raised once.
+    output.write('ok', 'content')
+    output.close()
+    assert (tmp_path / 'ok').read_text() == 'content'
+
+
+def test_output_directory_io_threads_submit_error(tmp_path):
+    output = main.OutputDirectory(str(tmp_path), io_threads=1, max_pending=1)
+    assert output._executor is not None
+    output._executor.shutdown()
+    # The queue slot is given back, so the next call doesn't block forever.
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            output.write('f', 'content')
+    output.close(raise_error=False)
+    assert not (tmp_path / 'f').exists()
+
+
+def test_output_directory_io_threads_superseded_operation(tmp_path):
+    output = main.OutputDirectory(str(tmp_path), io_threads=1)
+    old: concurrent.futures.Future[None] = concurrent.futures.Future()
+    new: concurrent.futures.Future[None] = concurrent.futures.Future()
+    old.set_result(None)
+    output._pending['f'] = new
+    output._slots.acquire()
+    # An operation finishing after a newer one was queued for the same path
+    # leaves the newer one pending.
+    output._done(('f',), old)
+    assert output._pending == {'f': new}
+    output.close()
+
+
+def test_io_threads_must_not_be_negative(tmp_path):
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', str(tmp_path / 'package-list'),
+            '--output-dir', str(tmp_path),
+            '--packages-url', '../../pool',
+            '--io-threads', '-1',
+        ))
+
+
+def test_build_repo_io_threads(tmp_path):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text(''.join(f'pkg{i}-{v}.tar.gz\n' for i in range(20) for v in ('1.0', '2.0')))
+    for output_dir, extra_args in (('serial', ()), ('threaded', ('--io-threads', '4'))):
+        main.main((
+            '--package-list', str(package_list),
+            '--output-dir', str(tmp_path / output_dir),
+            '--packages-url', '../../pool',
+            '--no-generate-timestamp',
+            *extra_args,
+        ))
+    assert _read_tree(tmp_path / 'threaded') == _read_tree(tmp_path / 'serial')
+
+
+def _read_manifest(path):
+    return sorted((entry['action'], entry['path'], entry.get('sha256')) for entry in map(json.loads, open(path)))
+
+
+def test_output_directory_manifest(tmp_path):
+    manifest = io.StringIO()
+    (tmp_path / 'existing').write_text('old')
+    (tmp_path / 'unchanged').write_text('same')
+    output = main.OutputDirectory(str(tmp_path), skip_unchanged=True, precompress=('gzip',), manifest=manifest)
+    output.write('a/new', 'new')
+    output.write('existing', iter(('ne', 'w')))
+    output.write('unchanged', 'same')
+    output.delete('existing')
+    output.delete('missing')
+    entries = [json.loads(line) for line in manifest.getvalue().splitlines()]
+    sha256 = main.hashlib.sha256(b'new').hexdigest()
+    assert entries[:2] == [
+        {'path': 'a/new', 'action': 'create', 'sha256': sha256},
+        {'path': 'a/new.gz', 'action': 'create', 'sha256': main.hashlib.sha256(
+            (tmp_path / 'a' / 'new.gz').read_bytes(),
+        ).hexdigest()},
+    ]
+    assert [(entry['path'], entry['action']) for entry in entries[2:]] == [
+        ('existing', 'update'),
+        ('existing.gz', 'create'),
+        ('unchanged.gz', 'create'),
+        ('existing', 'delete'),
+        ('existing.gz', 'delete'),
+    ]
+
+
+def test_build_repo_manifest(tmp_path):
+    package_list = tmp_path / 'package-list'
+    manifest = tmp_path / 'manifest'
+    output_dir = tmp_path / 'out'
+    argv = (
+        '--package-list', str(package_list),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool',
+        '--no-generate-timestamp',
+        '--incremental',
+        '--manifest', str(manifest),
+    )
+    package_list.write_text('a-1.0.tar.gz\nb-1.0.tar.gz\n')
+    main.main(argv)
+    first = _read_manifest(manifest)
+    assert {action for action, _, _ in first} == {'create'}
+    assert ('create', 'simple/a/index.html', main.hashlib.sha256(
+        (output_dir / 'simple' / 'a' / 'index.html').read_bytes(),
+    ).hexdigest()) in first
+
+    package_list.write_text('a-1.0.tar.gz\nb-2.0.tar.gz\n')
+    main.main(argv)
+    changed = {(action, path) for action, path, _ in _read_manifest(manifest)}
+    assert ('update', 'simple/b/index.html') in changed
+    assert ('create', 'pypi/b/2.0/json') in changed
+    assert ('delete', 'pypi/b/1.0/json') in changed
+    assert not any(path.startswith(('simple/a/', 'pypi/a/')) for _, path in changed)
+
+    # An unchanged input gives an empty manifest.
+    main.main(argv)
+    assert manifest.read_text() == ''
+
+
+def test_build_repo_prune(tmp_path):
+    settings = SETTINGS._replace(output_dir=str(tmp_path))
+    main.build_repo({
+        'a': {main.Package.create(filename='a-1.0.tar.gz'), main.Package.create(filename='a-2.0.tar.gz')},
+        'b': {main.Package.create(filename='b-1.0.tar.gz')},
+    }, None, settings)
+    (tmp_path / 'simple' / 'not-a-package.txt').write_text('')
+
+    # Without a previous build to compare to, nothing is deleted.
+    packages = {'a': {main.Package.create(filename='a-2.0.tar.gz')}}
+    main.build_repo(packages, None, settings)
+    assert (tmp_path / 'simple' / 'b' / 'index.html').exists()
+    assert (tmp_path / 'pypi' / 'a' / '1.0' / 'json').exists()
+
+    manifest = io.StringIO()
+    main.build_repo(packages, None, settings, main.OutputDirectory(str(tmp_path), manifest=manifest), prune=True)
+    for path in ('simple/b', 'project/b', 'pypi/b', 'pypi/a/1.0'):
+        assert not (tmp_path / path).exists()
+    assert (tmp_path / 'pypi' / 'a' / '2.0' / 'json').exists()
+    assert (tmp_path / 'simple' / 'not-a-package.txt').exists()
+    deleted = {
+        entry['path'] for entry in map(json.loads, manifest.getvalue().splitlines())
+        if entry['action'] == 'delete'
+    }
+    assert deleted == {
+        'simple/b/index.html',
+        'simple/b/index.json',
+        'project/b/index.html',
+        'pypi/b/json',
+        'pypi/b/1.0/json',
+        'pypi/a/1.0/json',
+    }
+
+
+def test_build_repo_prune_missing_directory(tmp_path):
+    settings = SETTINGS._replace(output_dir=str(tmp_path))
+    main.build_repo({
+        'a': {main.Package.create(filename='a-1.0.tar.gz')},
+        'b': {main.Package.create(filename='b-1.0.tar.gz')},
+    }, None, settings)
+    for path in ('project/a/index.html', 'project/b/index.html'):
+        (tmp_path / path).unlink()
+    for path in ('project/a', 'project/b', 'project'):
+        (tmp_path / path).rmdir()
+    main.build_repo({'a': {main.Package.create(filename='a-1.0.tar.gz')}}, None, settings, prune=True)
+    assert not (tmp_path / 'simple' / 'b').exists()
+    assert not (tmp_path / 'project' / 'b').exists()
+
+
+def test_build_repo_prune_with_previous_state(tmp_path):
+    settings = SETTINGS._replace(output_dir=str(tmp_path))
+    state = main.build_repo({
+        'a': {main.Package.create(filename='a-1.0.tar.gz'), main.Package.create(filename='a-2.0.tar.gz')},
+        'b': {main.Package.create(filename='b-1.0.tar.gz')},
+    }, None, settings)
+    (tmp_path / 'simple' / 'stray').mkdir()
+    (tmp_path / 'simple' / 'stray' / 'index.html').write_text('')
+
+    # Only the packages removed since the previous build are deleted, without
+    # scanning the output for others.
+    packages = {'a': {main.Package.create(filename='a-2.0.tar.gz')}}
+    main.build_repo(packages, None, settings, previous_state=state, prune=True)
+    for path in ('simple/b', 'project/b', 'pypi/b', 'pypi/a/1.0'):
+        assert not (tmp_path / path).exists()
+    assert (tmp_path / 'pypi' / 'a' / '2.0' / 'json').exists()
+    assert (tmp_path / 'simple' / 'stray' / 'index.html').exists()
+
+
+def test_build_repo_generations(tmp_path):
+    package_list = tmp_path / 'package-list'
+    output_dir = tmp_path / 'out'
+    argv = (
+        '--package-list', str(package_list),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool',
+        '--incremental',
+        '--generations',
+    )
+    package_list.write_text('a-1.0.tar.gz\nb-1.0.tar.gz\n')
+    main.main(argv)
+    assert os.readlink(output_dir / 'current') == os.path.join('.generations', '1')
+    first = output_dir / '.generations' / '1'
+    first_b = (first / 'simple' / 'b' / 'index.html').read_text()
+
+    package_list.write_text('a-1.0.tar.gz\nb-2.0.tar.gz\n')
+    main.main(argv)
+    assert os.readlink(output_dir / 'current') == os.path.join('.generations', '2')
+    second = output_dir / '.generations' / '2'
+    # Unchanged files are shared with the previous generation, and changed
+    # ones don't affect it.
+    assert os.path.samefile(first / 'simple' / 'a' / 'index.html', second / 'simple' / 'a' / 'index.html')
+    assert (first / 'simple' / 'b' / 'index.html').read_text() == first_b
+    assert 'b-2.0.tar.gz' in (output_dir / 'current' / 'simple' / 'b' / 'index.html').read_text()
+    assert not (second / 'pypi' / 'b' / '1.0').exists()
+    assert (first / 'pypi' / 'b' / '1.0' / 'json').exists()
+
+    # A generation left over from a failed build is cleaned up along with
+    # the ones beyond --keep-generations.
+    (output_dir / '.generations' / '3').mkdir()
+    package_list.write_text('a-1.0.tar.gz\nb-3.0.tar.gz\n')
+    main.main(argv)
+    assert sorted(os.listdir(output_dir / '.generations')) == ['2', '3']
+    assert os.readlink(output_dir / 'current') == os.path.join('.generations', '3')
+    assert 'b-3.0.tar.gz' in (output_dir / 'current' / 'simple' / 'b' / 'index.html').read_text()
+
+
+def test_build_repo_generations_first_build_is_complete(tmp_path):
+    package_list = tmp_path / 'package-list'
+    output_dir = tmp_path / 'out'
+    argv = (
+        '--package-list', str(package_list),
+        '--output-dir', str(output_dir),
+        '--packages-url', '../../pool',
+        '--incremental',
+    )
+    package_list.write_text('a-1.0.tar.gz\n')
+    main.main(argv)
+    package_list.write_text('a-1.0.tar.gz\nb-1.0.tar.gz\n')
+    main.main((*argv, '--generations'))
+    # Even though the previous (non-generation) build had package a, the
+    # first generation can't reuse its files.
+    assert (output_dir / 'current' / 'simple' / 'a' / 'index.html').exists()
+
+
+def test_generations_refuses_to_replace_directory(tmp_path):
+    (tmp_path / 'current').mkdir()
+    generation = main._start_generation(str(tmp_path))
+    with pytest.raises(ValueError):
+        main._switch_generation(str(tmp_path), generation, keep=2)
+
+
+@pytest.mark.parametrize('args', (
+    ('--keep-generations', '0'),
+    ('--generations',),
+))
+def test_build_repo_generations_invalid_args(tmp_path, args):
+    (tmp_path / 'current').mkdir()
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', str(tmp_path / 'package-list'),
+            '--output-dir', str(tmp_path),
+            '--packages-url', '../../pool',
+            *args,
+        ))
+
+
+def test_build_repo_memory_sink_matches_directory(tmp_path):
+    packages = {
+        'a': {main.Package.create(filename='a-1.0.tar.gz'), main.Package.create(filename='a-2.0.tar.gz')},
+        'b': {main.Package.create(filename='b-1.0.tar.gz')},
+    }
+    settings = SETTINGS._replace(output_dir=str(tmp_path), generate_timestamp=False)
+    sink = main.MemorySink()
+    main.build_repo(packages, None, settings, sink)
+    main.build_repo(packages, None, settings)
+    assert sink.files == _read_tree(tmp_path)
+    assert sink.written == len(sink.files)
+
+
+def test_output_sink_is_abstract():
+    class WriteOnlySink(main.OutputSink):
+        def write(self, path, content):
+            raise NotImplementedError
+
+    with pytest.raises(TypeError):
+        WriteOnlySink()  # type: ignore[abstract]
+
+
+def _read_tar(path, mode='r:*'):
+    files = {}
+    with tarfile.open(path, mode) as tar:
+        for member in tar:
+            f = tar.extractfile(member)
+            assert f is not None
+            files[member.name] = f.read()
+    return files
+
+
+@pytest.mark.parametrize(('filename', 'mode'), (
+    ('site.tar', 'r:'),
+    ('site.tar.gz', 'r:gz'),
+))
+def test_tar_sink(tmp_path, filename, mode):
+    path = str(tmp_path / filename)
+    with main.TarSink(path, compression=mode[2:] or None) as sink:
+        sink.write('a/index.html', 'hello')
+        sink.write('b/index.html', iter(('wor', 'ld')))
+        sink.delete('c/index.html')
+    assert _read_tar(path, mode) == {
+        'a/index.html': b'hello',
+        'b/index.html': b'world',
+        '.dumb-pypi/deleted': b'c/index.html\n',
+    }
+    assert os.listdir(tmp_path) == [filename]
+
+
+def test_tar_sink_zstd(tmp_path):
+    zstandard = pytest.importorskip('zstandard')
+    path = tmp_path / 'site.tar.zst'
+    with main.TarSink(str(path), compression='zst') as sink:
+        sink.write('a/index.html', 'hello')
+    (tmp_path / 'site.tar').write_bytes(zstandard.ZstdDecompressor().decompressobj().decompress(path.read_bytes()))
+    assert _read_tar(tmp_path / 'site.tar') == {'a/index.html': b'hello'}
+
+
+def test_tar_sink_failed_build_keeps_previous_archive(tmp_path):
+    path = tmp_path / 'site.tar'
+    path.write_bytes(b'previous')
+    with pytest.raises(RuntimeError):
+        with main.TarSink(str(path)) as sink:
+            sink.write('a', 'b')
+            raise RuntimeError()
+    assert path.read_bytes() == b'previous'
+    assert os.listdir(tmp_path) == ['site.tar']
+
+
+def test_memory_sink_delete():
+    sink = main.MemorySink()
+    sink.write('a', 'b')
+    sink.delete('a')
+    sink.delete('missing')
+    assert sink.files == {}
+    assert sink.deleted == 1
+
+
+def test_tar_sink_unsupported_compression(tmp_path):
+    with pytest.raises(ValueError):
+        main.TarSink(str(tmp_path / 'site.tar.xz'), compression='xz')
+
+
+def test_tar_sink_failed_close_keeps_previous_archive(tmp_path):
+    path = tmp_path / 'site.tar'
+    path.write_bytes(b'previous')
+    sink = main.TarSink(str(path))
+    sink.write('a', 'b')
+    close_tar = sink._tar.close
+
+    def failing_close():
+        close_tar()
+        raise OSError('disk full')
+
+    sink._tar.close = failing_close  # type: ignore[method-assign]
+    with pytest.raises(OSError):
+        sink.close()
+    assert path.read_bytes() == b'previous'
+    assert os.listdir(tmp_path) == ['site.tar']
+
+
+def test_build_repo_archive(tmp_path):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('pkg-1.0.tar.gz\n')
+    main.main((
+        '--package-list', str(package_list),
+        '--output-dir', str(tmp_path / 'directory'),
+        '--packages-url', '../../pool',
+        '--no-generate-timestamp',
+    ))
+    main.main((
+        '--package-list', str(package_list),
+        '--output-dir', str(tmp_path / 'state'),
+        '--packages-url', '../../pool',
+        '--no-generate-timestamp',
+        '--archive', str(tmp_path / 'site.tar.gz'),
+    ))
+    assert _read_tar(tmp_path / 'site.tar.gz') == _read_tree(tmp_path / 'directory')
+    assert not (tmp_path / 'state' / 'simple').exists()
+
+
+def test_build_repo_archive_zstd_missing(tmp_path, monkeypatch):
+    monkeypatch.setattr(main.importlib.util, 'find_spec', lambda name: None)
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', str(tmp_path / 'package-list'),
+            '--output-dir', str(tmp_path),
+            '--packages-url', '../../pool',
+            '--archive', 'site.tar.zst',
+        ))
+
+
+@pytest.mark.parametrize('args', (
+    ('--archive', 'site.zip'),
+    ('--archive', 'site.tar', '--prune'),
+    ('--archive', 'site.tar', '--precompress', 'gzip'),
+))
+def test_build_repo_archive_invalid_args(tmp_path, args):
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', str(tmp_path / 'package-list'),
+            '--output-dir', str(tmp_path),
+            '--packages-url', '../../pool',
+            *args,
+        ))
+
+
+def test_build_stats():
+    stats = main.BuildStats()
+    for _ in range(2):
+        with stats.phase('a'):
+            pass
+    stats.count('files', 3)
+    other = main.BuildStats()
+    with other.phase('a'):
+        pass
+    other.count('files')
+    stats.merge(other)
+    report = stats.report()
+    assert report['phases']['a']['calls'] == 3
+    assert report['phases']['a']['wall_seconds'] >= 0
+    assert report['counters'] == {'files': 4}
+    assert stats.summary().splitlines()[-1] == 'files: 4'
+
+
+@pytest.mark.parametrize('jobs', (1, 2))
+def test_build_repo_stats(tmpdir, jobs):
+    packages = {
+        'a': {main.Package.create(filename='a-1.0.tar.gz'), main.Package.create(filename='a-2.0.tar.gz')},
+        'b': {main.Package.create(filename='b-1.0.tar.gz')},
+    }
+    stats = main.BuildStats()
+    main.build_repo(packages, None, SETTINGS._replace(output_dir=tmpdir.strpath), jobs=jobs, stats=stats)
+    report = stats.report()
+    assert {
+        'sort', 'changelog_sort', 'digest', 'simple_index', 'package_pages', 'changelog', 'root_index',
+        'packages_json',
+    } <= report['phases'].keys()
+    assert report['phases']['render_simple_page']['calls'] == 2
+    assert report['phases']['render_release_json']['calls'] == 3
+    assert report['counters']['packages'] == 2
+    assert report['counters']['files'] == 3
+    assert report['counters']['changed_packages'] == 2
+    assert report['counters']['files_written'] == len(_read_tree(tmpdir))
+    assert report['counters']['bytes_written'] == sum(map(len, _read_tree(tmpdir).values()))
+
+
+def test_main_stats(tmp_path, capsys):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('pkg-1.0.tar.gz\n')
+    stats_path = tmp_path / 'stats.json'
+    args = (
+        '--package-list', str(package_list),
+        '--output-dir', str(tmp_path / 'out'),
+        '--packages-url', '../../pool',
+        '--incremental',
+        '--stats-json', str(stats_path),
+        '--stats',
+    )
+    main.main(args)
+    report = json.loads(stats_path.read_text())
+    assert {'parse', 'package_pages', 'close_output', 'save_state'} <= report['phases'].keys()
+    assert report['counters']['packages'] == 1
+    assert 'package_pages' in capsys.readouterr().err
+
+    # When the input is unchanged, the report says so.
+    main.main(args)
+    assert json.loads(stats_path.read_text())['counters'] == {'up_to_date': 1}
+
+
+def test_main_profile_pstats(tmp_path):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('pkg-1.0.tar.gz\n')
+    main.main((
+        '--package-list', str(package_list),
+        '--output-dir', str(tmp_path / 'out'),
+        '--packages-url', '../../pool',
+        '--profile', str(tmp_path / 'build.prof'),
+    ))
+    functions = pstats.Stats(str(tmp_path / 'build.prof')).get_stats_profile().func_profiles
+    assert {'build_repo', 'package_list'} <= functions.keys()
+
+
+@pytest.mark.skipif(not hasattr(signal, 'setitimer'), reason='needs SIGPROF')
+def test_sampling_profiler(tmp_path):
+    stats = main.BuildStats()
+    with stats.phase('outer'), stats.phase('inner'):
+        with main._SamplingProfiler(stats) as sampler:
+            start = time.process_time()
+            while time.process_time() - start < 0.1:
+                pass
+    assert sampler.samples
+    assert all(stack.startswith('phase:outer;phase:inner;') for stack in sampler.samples)
+    assert not stats.active
+
+    sampler.save(str(tmp_path / 'stacks'))
+    for line in (tmp_path / 'stacks').read_text().splitlines():
+        stack, count = line.rsplit(' ', 1)
+        assert sampler.samples[stack] == int(count)
+
+
+@pytest.mark.skipif(not hasattr(signal, 'setitimer'), reason='needs SIGPROF')
+def test_main_profile_collapsed(tmp_path):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('pkg-1.0.tar.gz\n')
+    main.main((
+        '--package-list', str(package_list),
+        '--output-dir', str(tmp_path / 'out'),
+        '--packages-url', '../../pool',
+        '--profile', str(tmp_path / 'build.folded'),
+        '--profile-format', 'collapsed',
+    ))
+    # The build is too quick to be sure it gets sampled at all.
+    assert (tmp_path / 'build.folded').exists()
+
+
+def test_main_profile_collapsed_needs_sigprof(tmp_path, monkeypatch):
+    monkeypatch.delattr(main.signal, 'setitimer', raising=False)
+    with pytest.raises(SystemExit):
+        main.main((
+            '--package-list', str(tmp_path / 'package-list'),
+            '--output-dir', str(tmp_path / 'out'),
+            '--packages-url', '../../pool',
+            '--profile', str(tmp_path / 'build.folded'),
+            '--profile-format', 'collapsed',
+        ))
+
+
+def test_build_repo_prune_needs_directory():
+    with pytest.raises(ValueError):
+        main.build_repo({}, None, SETTINGS, main.MemorySink(), prune=True)
+
+
+def test_build_repo_archive_up_to_date(tmp_path):
+    package_list = tmp_path / 'package-list'
+    package_list.write_text('pkg-1.0.tar.gz\n')
+    args = (
+        '--package-list', str(package_list),
+        '--output-dir', str(tmp_path / 'state'),
+        '--packages-url', '../../pool',
+        '--incremental',
+        '--archive', str(tmp_path / 'site.tar'),
+    )
+    main.main(args)
+    assert 'index.html' in _read_tar(tmp_path / 'site.tar')
+    main.main(args)
+    assert _read_tar(tmp_path / 'site.tar') == {}
+
+
 def test_sorting():
     test_packages = [
         main.Package.create(filename=name)
@@ -593,6 +2348,7 @@ def test_sorting():
         )
     ]
     sorted_names = [package.filename for package in sorted(test_packages)]
+    assert sorted(test_packages) == sorted(test_packages, key=lambda p: p.sort_key)
     assert sorted_names == [
         'aspy.yaml-0.2.0-py2-none-any.whl',
         'aspy.yaml-0.2.1-py2-none-any.whl',